@@ -0,0 +1,461 @@
+import os
+import sys
+import argparse
+import asyncio
+import json
+import random
+import shutil
+import tempfile
+import time
+import types
+import zlib
+
+from telethon import events
+from telethon.errors import FloodWaitError, UsernameNotOccupiedError
+from telethon.tl.functions.channels import GetParticipantsRequest
+from telethon.tl.functions.contacts import ResolveUsernameRequest
+
+# Offline benchmarks for bot.py. bot.py is imported against an in-memory config
+# inside a scratch directory, its Telegram clients are replaced with the fakes
+# below, and main() runs as usual; updates are then fed to the handlers main()
+# registered, so they take the same path (serializer, router, admission gates,
+# outbox) as live traffic.
+#
+#   python bench.py                        # dispatch, flows, log and report_count
+#   python bench.py report_count --sizes 1000,100000,10000000
+#   python bench.py dispatch --updates 5000 --save-stream updates.jsonl
+#   python bench.py replay updates.jsonl --speed 10
+#
+# Replay streams are JSON lines: {"t": seconds since start, "type": "message"
+# or "callback", "sender_id": ..., "chat_id": ..., "text": ... / "data": ...}.
+# Record real traffic by setting UPDATE_RECORD_FILE in the live bot's config.py;
+# --save-stream writes the synthetic dispatch workload in the same format.
+
+ADMINS = range(1, 101)
+STRANGERS = range(1000, 1100)
+ACTIONS = ("report_spam", "report_violence", "report_fake", "report_other", "note")
+
+class FakeNetwork:
+    # Latency injection shared by every fake client; FloodWait is only injected
+    # into account API requests (ResolveUsername, GetParticipants).
+    def __init__(self, api_latency=0.0, send_latency=0.0, flood_rate=0.0, flood_seconds=5, seed=0):
+        self.api_latency = api_latency
+        self.send_latency = send_latency
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self.random = random.Random(seed)
+
+    async def call(self, latency, flood=False):
+        if latency:
+            await asyncio.sleep(latency)
+        if flood and self.flood_rate and self.random.random() < self.flood_rate:
+            raise FloodWaitError(request=None, capture=self.flood_seconds)
+
+network = FakeNetwork()
+
+class FakeClient:
+    # Stands in for a reporting account's TelegramClient.
+    def __init__(self, session, api_id=None, api_hash=None, proxy=None):
+        self.session = session
+        self.connected = False
+
+    async def connect(self):
+        await network.call(network.api_latency)
+        self.connected = True
+
+    async def disconnect(self):
+        self.connected = False
+
+    def is_connected(self):
+        return self.connected
+
+    async def is_user_authorized(self):
+        return True
+
+    async def send_code_request(self, phone):
+        await network.call(network.api_latency)
+        return types.SimpleNamespace(phone_code_hash="bench")
+
+    async def sign_in(self, phone=None, code=None, phone_code_hash=None):
+        await network.call(network.api_latency)
+
+    async def get_me(self):
+        return types.SimpleNamespace(id=zlib.crc32(self.session.encode()), username=None)
+
+    async def __call__(self, request):
+        await network.call(network.api_latency, flood=True)
+        if isinstance(request, ResolveUsernameRequest):
+            name = request.username
+            if name.startswith("missing"):
+                raise UsernameNotOccupiedError(request=request)
+            return types.SimpleNamespace(users=[types.SimpleNamespace(id=zlib.crc32(name.encode()), username=name)])
+        if isinstance(request, GetParticipantsRequest):
+            return types.SimpleNamespace(users=[types.SimpleNamespace(id=10_000 + i, username=f"member{i}")
+                                                for i in range(200)])
+        raise NotImplementedError(type(request).__name__)
+
+class FakeBot(FakeClient):
+    # Stands in for the bot's own client: collects registered handlers and sent messages.
+    def __init__(self):
+        super().__init__("bot_session")
+        self.handlers = {}
+        self.sent = 0
+
+    async def start(self, bot_token=None):
+        self.connected = True
+        return self
+
+    def add_event_handler(self, callback, event):
+        self.handlers[type(event)] = callback
+
+    async def send_message(self, chat_id, text, buttons=None):
+        await network.call(network.send_latency)
+        self.sent += 1
+
+    async def send_file(self, chat_id, file, caption=None, force_document=False):
+        await network.call(network.send_latency)
+        self.sent += 1
+
+class FakeEvent:
+    # The parts of NewMessage.Event / CallbackQuery.Event the handlers use.
+    # done resolves when the update's handler has finished.
+    def __init__(self, sender_id, chat_id, text="", data=None):
+        self.sender_id = sender_id
+        self.chat_id = chat_id
+        self.message = types.SimpleNamespace(message=text, text=text)
+        self.raw_text = self.text = text
+        self.data = data
+        self.done = asyncio.get_running_loop().create_future()
+
+    def finish(self):
+        if not self.done.done():
+            self.done.set_result(time.perf_counter())
+
+    async def respond(self, text, buttons=None):
+        await BOT.send_message(self.chat_id, text, buttons=buttons)
+
+    reply = respond
+
+    async def answer(self, text=None, alert=False):
+        await network.call(network.send_latency)
+
+    async def edit(self, text, buttons=None):
+        await network.call(network.send_latency)
+
+    async def get_chat(self):
+        return types.SimpleNamespace(id=self.chat_id)
+
+BOT = FakeBot()
+
+def make_config(args):
+    config = types.ModuleType("config")
+    config.BOT_TOKEN = "bench"
+    config.BOT_API_ID = 1
+    config.BOT_API_HASH = "bench"
+    config.ADMIN_IDS = list(ADMINS)
+    config.ACCOUNT_DETAILS = [
+        {"phone": f"+1555000000{i}", "api_id": 1, "api_hash": "bench", "session": f"bench_{i}", "proxy": None}
+        for i in range(args.accounts)
+    ]
+    config.SIM_LOG_DURABILITY = args.durability
+    config.REPLY_MIN_INTERVAL = 0
+    config.REPLY_COALESCE_WINDOW = 0
+    config.METRICS_FILE = None
+    return config
+
+def load_bot(args):
+    # Must run inside the scratch directory: bot.py keeps its files relative to cwd.
+    sys.modules["config"] = make_config(args)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import bot
+    bot.bot = BOT
+    bot.TelegramClient = FakeClient
+    # Mark queued updates so inject() can wait for the serializer to run them.
+    submit = bot.user_serializer.submit
+
+    def tracked_submit(uid, handler, event, *rest):
+        async def run(*a):
+            try:
+                await handler(*a)
+            finally:
+                event.finish()
+        event.queued = True
+        submit(uid, run, event, *rest)
+
+    bot.user_serializer.submit = tracked_submit
+    return bot
+
+async def inject(event) -> float:
+    # Feeds one update through the handler main() registered; returns its latency.
+    started = time.perf_counter()
+    event.queued = False
+    if event.data is None:
+        await BOT.handlers[events.NewMessage](event)
+    else:
+        await BOT.handlers[events.CallbackQuery](event)
+    if event.queued:
+        return await event.done - started
+    return time.perf_counter() - started
+
+def message(sender_id, text, chat_id=None):
+    return FakeEvent(sender_id, sender_id if chat_id is None else chat_id, text)
+
+def callback(sender_id, data, chat_id=None):
+    return FakeEvent(sender_id, sender_id if chat_id is None else chat_id, data=data.encode())
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+def report(name, latencies, elapsed=None):
+    # Throughput is only shown when the series had its own wall-clock span.
+    values = sorted(latencies)
+    rate = f"{len(values) / elapsed:>10.0f}/s" if elapsed else " " * 12
+    print(f"{name:<40} n={len(values):<8} {rate}  p50={percentile(values, 0.5) * 1000:8.2f}ms"
+          f"  p99={percentile(values, 0.99) * 1000:8.2f}ms  max={(values[-1] if values else 0) * 1000:8.2f}ms")
+
+def generate_updates(count, users, usernames, seed):
+    # A mix of cheap, gated and denied commands plus menu callbacks.
+    rng = random.Random(seed)
+    admins = list(ADMINS)[:users]
+    for _ in range(count):
+        kind = rng.random()
+        uid = rng.choice(admins)
+        if kind < 0.25:
+            yield {"type": "message", "sender_id": uid, "text": "/start"}
+        elif kind < 0.40:
+            yield {"type": "message", "sender_id": uid, "text": f"/simulate_report target{rng.randrange(1000)}"}
+        elif kind < 0.55:
+            yield {"type": "message", "sender_id": uid, "text": "/report_count " + rng.choice(("", "hour", "day"))}
+        elif kind < 0.70:
+            yield {"type": "message", "sender_id": uid, "text": f"/resolve @user{rng.randrange(usernames)}"}
+        elif kind < 0.80:
+            yield {"type": "callback", "sender_id": uid, "data": "list_accounts"}
+        elif kind < 0.90:
+            yield {"type": "message", "sender_id": rng.choice(STRANGERS), "text": "/list"}
+        else:
+            yield {"type": "message", "sender_id": uid, "text": "hello"}
+
+def to_event(update):
+    chat_id = update.get("chat_id")
+    if update["type"] == "callback":
+        return callback(update["sender_id"], update["data"], chat_id)
+    return message(update["sender_id"], update["text"], chat_id)
+
+def command_name(update):
+    if update["type"] == "callback":
+        return "callback " + update["data"].split(":", 1)[0]
+    text = update["text"]
+    return text.split()[0] if text.startswith("/") else "non-command"
+
+async def bench_dispatch(bot, args):
+    print(f"\n== dispatch: {args.updates} updates from {args.users} concurrent users ==")
+    updates = list(generate_updates(args.updates, args.users, args.usernames, args.seed))
+    if args.save_stream:
+        with open(args.save_stream, "w", encoding="utf-8") as f:
+            for i, update in enumerate(updates):
+                f.write(json.dumps(dict(update, t=round(i * args.interval, 6))) + "\n")
+        print(f"Saved update stream to {args.save_stream}")
+    by_user = {}
+    for update in updates:
+        by_user.setdefault(update["sender_id"], []).append(update)
+    latencies = {}
+
+    async def user(stream):
+        # Each user sends its next update once the previous one is handled.
+        for update in stream:
+            latencies.setdefault(command_name(update), []).append(await inject(to_event(update)))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user(stream) for stream in by_user.values()))
+    elapsed = time.perf_counter() - started
+    report("all updates", [x for values in latencies.values() for x in values], elapsed)
+    for name, values in sorted(latencies.items()):
+        report(f"  {name}", values)
+    rejected = {name: gate.rejected for name, gate in bot.ADMISSION_GATES.items() if gate.rejected}
+    if rejected:
+        print(f"Admission rejections: {rejected}")
+
+async def bench_flows(bot, args):
+    print(f"\n== generic_flow: {args.flows} add + delete flows from {args.users} concurrent admins ==")
+    steps = {}
+    totals = {"add": [], "delete": []}
+
+    async def run_flow(kind, uid, texts):
+        started = time.perf_counter()
+        for i, text in enumerate(texts):
+            steps.setdefault(f"{kind} step {i}", []).append(await inject(message(uid, text)))
+        totals[kind].append(time.perf_counter() - started)
+
+    async def admin(uid, count):
+        for n in range(count):
+            phone = f"+1999{uid:04d}{n:06d}"
+            await run_flow("add", uid, ["/add", phone, "12345", "0123456789abcdef", f"bench_{uid}_{n}", "12345"])
+            await run_flow("delete", uid, ["/delete", phone])
+
+    admins = list(ADMINS)[:args.users]
+    per_admin, extra = divmod(args.flows, len(admins))
+    started = time.perf_counter()
+    await asyncio.gather(*(admin(uid, per_admin + (i < extra)) for i, uid in enumerate(admins)))
+    elapsed = time.perf_counter() - started
+    report("add flow (6 messages)", totals["add"], elapsed)
+    report("delete flow (2 messages)", totals["delete"], elapsed)
+    for name, values in sorted(steps.items()):
+        report(f"  {name}", values)
+
+async def bench_log(bot, args):
+    print(f"\n== log_simulated_action: {args.rows} rows (durability={args.durability}) ==")
+    latencies = []
+    started = time.perf_counter()
+    for i in range(args.rows):
+        t = time.perf_counter()
+        bot.log_simulated_action(ACTIONS[i % len(ACTIONS)], f"target{i % 997}", str(ADMINS[i % 20]), "bench")
+        latencies.append(time.perf_counter() - t)
+        if i % 1000 == 999:
+            await asyncio.sleep(0)
+    submitted = time.perf_counter() - started
+    await asyncio.to_thread(bot.sim_log.flush)
+    written = time.perf_counter() - started
+    report("submit (caller side)", latencies, submitted)
+    print(f"{'written to disk':<40} n={args.rows:<8} {args.rows / written:>10.0f}/s  total={written:.2f}s")
+
+async def populate_log(bot, rows, first, total, t0, span):
+    # Rows with timestamps spread evenly over the span ending at t0, oldest first,
+    # so the log only reaches the recent hour/day windows at the largest size.
+    sim_log = bot.sim_log
+    for i in range(first, first + rows):
+        ts = t0 - span + span * i / total
+        row = [time.strftime(bot.SIM_LOG_TS_FORMAT, time.gmtime(ts)), ACTIONS[i % len(ACTIONS)],
+               f"target{i % 997}", str(ADMINS[i % 50]), ""]
+        sim_log.submit(row, ts)
+        if i % 1000 == 999:
+            await asyncio.sleep(0)
+        if i % 100_000 == 99_999:
+            # Keep the writer queue (and memory) bounded while loading.
+            await asyncio.to_thread(sim_log.flush)
+    await asyncio.to_thread(sim_log.flush)
+
+async def bench_report_count(bot, args):
+    sizes = sorted(int(s) for s in args.sizes.split(","))
+    print(f"\n== /report_count at log sizes {', '.join(f'{s:,}' for s in sizes)} ==")
+    t0, span = time.time(), 14 * 86400
+    base = bot.sim_log_stats.total
+    for size in sizes:
+        have = bot.sim_log_stats.total - base
+        if size > have:
+            started = time.perf_counter()
+            await populate_log(bot, size - have, have, sizes[-1], t0, span)
+            elapsed = time.perf_counter() - started
+            print(f"loaded {size - have:,} rows in {elapsed:.2f}s ({(size - have) / elapsed:,.0f} rows/s)")
+        for window in ("", "hour", "day", "week"):
+            latencies = [await inject(message(ADMINS[0], f"/report_count {window}".strip()))
+                         for _ in range(args.repeat)]
+            report(f"  {size:>10,} rows /report_count {window}", latencies)
+
+async def bench_replay(bot, args):
+    with open(args.stream, encoding="utf-8") as f:
+        updates = [json.loads(line) for line in f if line.strip()]
+    duration = updates[-1].get("t", 0) / args.speed if updates else 0
+    print(f"\n== replay: {len(updates)} updates from {args.stream} at {args.speed:g}x ({duration:.1f}s) ==")
+    latencies = {}
+    lateness = []
+    pending = []
+
+    async def run(update):
+        latencies.setdefault(command_name(update), []).append(await inject(to_event(update)))
+
+    started = time.perf_counter()
+    for update in updates:
+        due = started + update.get("t", 0) / args.speed
+        delay = due - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        lateness.append(max(0.0, time.perf_counter() - due))
+        pending.append(asyncio.create_task(run(update)))
+    await asyncio.gather(*pending)
+    elapsed = time.perf_counter() - started
+    report("all updates", [x for values in latencies.values() for x in values], elapsed)
+    for name, values in sorted(latencies.items()):
+        report(f"  {name}", values)
+    report("injection lateness", lateness)
+    rejected = {name: gate.rejected for name, gate in bot.ADMISSION_GATES.items() if gate.rejected}
+    if rejected:
+        print(f"Admission rejections: {rejected}")
+
+BENCHMARKS = {
+    "report_count": bench_report_count,
+    "dispatch": bench_dispatch,
+    "flows": bench_flows,
+    "log": bench_log,
+    "replay": bench_replay,
+}
+
+async def run(args):
+    bot = load_bot(args)
+    main = asyncio.create_task(bot.main())
+    while events.NewMessage not in BOT.handlers or not bot.sim_log_ready.is_set():
+        if main.done():
+            main.result()
+            raise RuntimeError("bot.main() exited before registering handlers")
+        await asyncio.sleep(0.01)
+    try:
+        # report_count runs first: it loads rows with past timestamps, and the
+        # log expects rows in time order.
+        names = [n for n in BENCHMARKS if n != "replay"] if args.benchmark == "all" else [args.benchmark]
+        for name in names:
+            await BENCHMARKS[name](bot, args)
+        print(f"\nBot sent {BOT.sent} messages.")
+        if args.stats:
+            print("\n" + bot.metrics.summary())
+    finally:
+        main.cancel()
+        try:
+            await main
+        except asyncio.CancelledError:
+            pass
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmarks for bot.py with a fake Telegram client.")
+    parser.add_argument("benchmark", nargs="?", default="all", choices=["all"] + list(BENCHMARKS))
+    parser.add_argument("stream", nargs="?", help="JSONL update stream for replay")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed multiplier")
+    parser.add_argument("--updates", type=int, default=2000, help="updates for the dispatch benchmark")
+    parser.add_argument("--users", type=int, default=20, help="concurrent users (at most 100)")
+    parser.add_argument("--usernames", type=int, default=500, help="distinct @usernames used by /resolve")
+    parser.add_argument("--flows", type=int, default=200, help="add + delete flows to run")
+    parser.add_argument("--rows", type=int, default=100_000, help="rows for the log write benchmark")
+    parser.add_argument("--sizes", default="1000,10000,100000,1000000",
+                        help="comma-separated log sizes for /report_count (e.g. up to 10000000)")
+    parser.add_argument("--repeat", type=int, default=20, help="/report_count calls per size and window")
+    parser.add_argument("--accounts", type=int, default=2, help="fake reporting accounts")
+    parser.add_argument("--api-latency", type=float, default=0.02, help="seconds per fake account API call")
+    parser.add_argument("--send-latency", type=float, default=0.0, help="seconds per fake bot send")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="fraction of API calls raising FloodWait")
+    parser.add_argument("--flood-seconds", type=int, default=5, help="FloodWait seconds to report")
+    parser.add_argument("--durability", default="fsync", choices=["fsync", "none"], help="SIM_LOG_DURABILITY")
+    parser.add_argument("--interval", type=float, default=0.01, help="seconds between updates in --save-stream")
+    parser.add_argument("--save-stream", help="write the dispatch updates as a replayable JSONL stream")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--stats", action="store_true", help="print the bot's /stats summary at the end")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch directory")
+    args = parser.parse_args(argv)
+    if args.benchmark == "replay" and not args.stream:
+        parser.error("replay needs a stream file")
+    args.users = max(1, min(args.users, len(ADMINS)))
+    return args
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.stream:
+        args.stream = os.path.abspath(args.stream)
+    if args.save_stream:
+        args.save_stream = os.path.abspath(args.save_stream)
+    network = FakeNetwork(args.api_latency, args.send_latency, args.flood_rate, args.flood_seconds, args.seed)
+    workdir = tempfile.mkdtemp(prefix="miko-bench-")
+    os.chdir(workdir)
+    try:
+        asyncio.run(run(args))
+    finally:
+        if args.keep:
+            print(f"Scratch directory kept at {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
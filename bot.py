@@ -1,16 +1,39 @@
 import os
 import asyncio
+import bisect
+import contextlib
 import csv
+import functools
+import gzip
+import heapq
+import io
+import itertools
+import json
+import queue
 import re
-from datetime import datetime, timedelta
-from typing import Dict, Any
+import resource
+import secrets
+import shlex
+import shutil
+import signal
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import traceback
+from array import array
+from datetime import datetime, timedelta, timezone
+from collections import Counter, OrderedDict, deque, namedtuple
+from typing import Dict, Any, Optional
 
 from telethon import TelegramClient, events, Button, __version__ as telethon_version
 from telethon.tl.functions.contacts import ResolveUsernameRequest
 from telethon.tl.functions.channels import GetParticipantsRequest
 from telethon.tl.types import ChannelParticipantsRecent
 from telethon.tl.types import User, Channel, Chat
-from telethon.errors import FloodWaitError, SessionPasswordNeededError
+from telethon.errors import FloodWaitError, SessionPasswordNeededError, UsernameInvalidError, UsernameNotOccupiedError
 
 import config
 
@@ -21,7 +44,7 @@ except NameError:
     print("Script path: Unable to determine (running in an interactive environment)")
 
 BOT_TOKEN = getattr(config, "BOT_TOKEN", None)
-ADMIN_IDS = getattr(config, "ADMIN_IDS", [])
+ADMIN_IDS = frozenset(getattr(config, "ADMIN_IDS", []))
 MAX_REPORTS = getattr(config, "MAX_REPORTS", 50)
 
 if hasattr(config, "ACCOUNT_DETAILS"):
@@ -45,12 +68,46 @@ else:
 BOT_API_ID = getattr(config, "BOT_API_ID", ACCOUNT_DETAILS[0]['api_id'] if ACCOUNT_DETAILS else None)
 BOT_API_HASH = getattr(config, "BOT_API_HASH", ACCOUNT_DETAILS[0]['api_hash'] if ACCOUNT_DETAILS else None)
 
-username_to_id: Dict[str, int] = {}
 SUDO_APPROVED_USERS: Dict[int, datetime] = {}
-user_states: Dict[int, Dict[str, Any]] = {}
 reporting_clients = []
 
 SIM_LOG_FILE = "simulated_actions.csv"
+SIM_LOG_HEADER = ["Timestamp", "Action", "Target", "Performed By", "Details"]
+SIM_LOG_FLUSH_ROWS = getattr(config, "SIM_LOG_FLUSH_ROWS", 100)
+SIM_LOG_FLUSH_INTERVAL = getattr(config, "SIM_LOG_FLUSH_INTERVAL", 1.0)
+SIM_LOG_DURABILITY = getattr(config, "SIM_LOG_DURABILITY", "fsync")
+SIM_LOG_CHECKPOINT = getattr(config, "SIM_LOG_CHECKPOINT", "simulated_actions.checkpoint.json")
+SIM_LOG_CHECKPOINT_INTERVAL = getattr(config, "SIM_LOG_CHECKPOINT_INTERVAL", 60.0)
+SIM_LOG_TS_FORMAT = "%Y-%m-%d %H:%M:%S"
+SIM_LOG_SEGMENT_DIR = getattr(config, "SIM_LOG_SEGMENT_DIR", "simulated_actions_segments")
+SIM_LOG_INDEX = getattr(config, "SIM_LOG_INDEX", "simulated_actions.index.json")
+SIM_LOG_SEGMENT_SECONDS = getattr(config, "SIM_LOG_SEGMENT_SECONDS", 86400)
+SIM_LOG_BLOCK_ROWS = getattr(config, "SIM_LOG_BLOCK_ROWS", 1000)
+SUDO_NOTIFY_CONCURRENCY = getattr(config, "SUDO_NOTIFY_CONCURRENCY", 10)
+LOG_SEARCH_PAGE_SIZE = getattr(config, "LOG_SEARCH_PAGE_SIZE", 10)
+LOG_SEARCH_MAX_SESSIONS = getattr(config, "LOG_SEARCH_MAX_SESSIONS", 200)
+USERNAME_CACHE_SIZE = getattr(config, "USERNAME_CACHE_SIZE", 5000)
+USERNAME_CACHE_TTL = getattr(config, "USERNAME_CACHE_TTL", 3600)
+USERNAME_NEGATIVE_TTL = getattr(config, "USERNAME_NEGATIVE_TTL", 300)
+STATE_DB = getattr(config, "STATE_DB", "bot_state.db")
+STATE_FLUSH_INTERVAL = getattr(config, "STATE_FLUSH_INTERVAL", 0.5)
+REPLY_MIN_INTERVAL = getattr(config, "REPLY_MIN_INTERVAL", 1.0)
+REPLY_COALESCE_WINDOW = getattr(config, "REPLY_COALESCE_WINDOW", 0.1)
+MESSAGE_LIMIT = 4096
+ADMISSION_LIMITS = {"api": (2, 10), "log": (4, 20), "export": (1, 2)}
+ADMISSION_LIMITS.update(getattr(config, "ADMISSION_LIMITS", {}))
+METRICS_ENABLED = getattr(config, "METRICS_ENABLED", True)
+METRICS_FILE = getattr(config, "METRICS_FILE", "bot_metrics.prom")
+METRICS_INTERVAL = getattr(config, "METRICS_INTERVAL", 30.0)
+METRICS_TRACEMALLOC = getattr(config, "METRICS_TRACEMALLOC", False)
+USE_UVLOOP = getattr(config, "USE_UVLOOP", True)
+LOOP_LAG_THRESHOLD = getattr(config, "LOOP_LAG_THRESHOLD", 0.5)
+LOOP_WATCHDOG_INTERVAL = getattr(config, "LOOP_WATCHDOG_INTERVAL", 0.1)
+FLOW_IDLE_TIMEOUT = getattr(config, "FLOW_IDLE_TIMEOUT", 600)
+FLOW_MAX_ACTIVE = getattr(config, "FLOW_MAX_ACTIVE", 1000)
+UPDATE_RECORD_FILE = getattr(config, "UPDATE_RECORD_FILE", None)
+SESSION_RETRY_BACKOFF = getattr(config, "SESSION_RETRY_BACKOFF", 5.0)
+SESSION_RETRY_MAX = getattr(config, "SESSION_RETRY_MAX", 300.0)
 
 def parse_message_link(link: str):
     pattern = r"https://t\.me/(?:c/)?([^/]+)/(\d+)"
@@ -78,456 +135,2519 @@ def parse_duration(duration_str: str) -> int:
         raise ValueError("Invalid time unit")
     return amount * multipliers[unit]
 
-def log_simulated_action(action: str, target: str, performed_by: str, details: str = ""):
-    header_needed = not os.path.isfile(SIM_LOG_FILE)
-    with open(SIM_LOG_FILE, "a", newline="", encoding="utf-8") as f:
-        writer = csv.writer(f)
-        if header_needed:
-            writer.writerow(["Timestamp", "Action", "Target", "Performed By", "Details"])
-        writer.writerow([datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"), action, target, performed_by, details])
-
-async def check_sudo_expirations():
-    while True:
-        now = datetime.utcnow()
-        expired = [uid for uid, exp in SUDO_APPROVED_USERS.items() if now >= exp]
-        for uid in expired:
-            SUDO_APPROVED_USERS.pop(uid, None)
+class Histogram:
+    # Fixed-bucket latency histogram; observe() is one bisect and a few adds.
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+    __slots__ = ("counts", "count", "sum", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q: float) -> float:
+        # Estimate interpolated linearly inside the bucket holding the
+        # q-quantile, never above the largest observed value.
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lower = self.BUCKETS[i - 1] if i else 0.0
+                upper = self.BUCKETS[i] if i < len(self.BUCKETS) else self.max
+                return min(self.max, lower + (upper - lower) * (rank - seen) / n)
+            seen += n
+        return self.max
+
+class _ApiTimer:
+    __slots__ = ("metrics", "name", "started")
+
+    def __init__(self, metrics, name: str):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        m = self.metrics
+        hist = m.api.get(self.name)
+        if hist is None:
+            hist = m.api[self.name] = Histogram()
+        hist.observe(time.perf_counter() - self.started)
+        if exc_type is not None:
+            m.api_errors[self.name] += 1
+            if isinstance(exc, FloodWaitError):
+                m.flood_waits += 1
+                m.flood_wait_seconds += exc.seconds
+        return False
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+class Metrics:
+    # Handler and Telegram API latency histograms, FloodWait totals and gauges
+    # (queue depths and the like, sampled only when rendered). When disabled,
+    # timed() returns handlers unchanged and api() is a no-op.
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.handlers: Dict[str, Histogram] = {}
+        self.handler_errors = Counter()
+        self.api: Dict[str, Histogram] = {}
+        self.api_errors = Counter()
+        self.flood_waits = 0
+        self.flood_wait_seconds = 0
+        self.gauges: Dict[str, Any] = {}
+        self._null = _NullTimer()
+
+    def timed(self, handler, name: str = None):
+        if not self.enabled:
+            return handler
+        hist = self.handlers.setdefault(name or handler.__name__, Histogram())
+        errors = self.handler_errors
+        label = name or handler.__name__
+
+        @functools.wraps(handler)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await handler(*args, **kwargs)
+            except Exception:
+                errors[label] += 1
+                raise
+            finally:
+                hist.observe(time.perf_counter() - started)
+        return wrapper
+
+    def api_call(self, name: str):
+        # Usage: with metrics.api_call("ResolveUsernameRequest"): await client(...)
+        return _ApiTimer(self, name) if self.enabled else self._null
+
+    def gauge(self, name: str, read):
+        self.gauges[name] = read
+
+    def read_gauges(self) -> Dict[str, float]:
+        values = {}
+        for name, read in self.gauges.items():
             try:
-                await bot.send_message(uid, "Your sudo approval has expired.")
+                values[name] = float(read())
             except Exception:
                 pass
-        await asyncio.sleep(60)
+        return values
+
+    def memory(self) -> Dict[str, float]:
+        values = {"max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            values["traced_current_bytes"] = current
+            values["traced_peak_bytes"] = peak
+        return values
+
+    @staticmethod
+    def top_allocations(limit: int = 5):
+        if not tracemalloc.is_tracing():
+            return []
+        stats = tracemalloc.take_snapshot().statistics("lineno")[:limit]
+        return [(f"{s.traceback[0].filename.rsplit(os.sep, 1)[-1]}:{s.traceback[0].lineno}", s.size, s.count)
+                for s in stats]
+
+    def render_prometheus(self) -> str:
+        lines = []
+
+        def histogram(metric, label, series):
+            lines.append(f"# TYPE {metric} histogram")
+            for key, hist in sorted(series.items()):
+                cumulative = 0
+                for bound, n in zip(Histogram.BUCKETS + (float("inf"),), hist.counts):
+                    cumulative += n
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f'{metric}_bucket{{{label}="{key}",le="{le}"}} {cumulative}')
+                lines.append(f'{metric}_sum{{{label}="{key}"}} {hist.sum}')
+                lines.append(f'{metric}_count{{{label}="{key}"}} {hist.count}')
+
+        histogram("miko_handler_seconds", "handler", self.handlers)
+        lines.append("# TYPE miko_handler_errors_total counter")
+        lines.extend(f'miko_handler_errors_total{{handler="{k}"}} {v}' for k, v in sorted(self.handler_errors.items()))
+        histogram("miko_api_seconds", "request", self.api)
+        lines.append("# TYPE miko_api_errors_total counter")
+        lines.extend(f'miko_api_errors_total{{request="{k}"}} {v}' for k, v in sorted(self.api_errors.items()))
+        lines.append("# TYPE miko_flood_waits_total counter")
+        lines.append(f"miko_flood_waits_total {self.flood_waits}")
+        lines.append("# TYPE miko_flood_wait_seconds_total counter")
+        lines.append(f"miko_flood_wait_seconds_total {self.flood_wait_seconds}")
+        lines.append("# TYPE miko_gauge gauge")
+        lines.extend(f'miko_gauge{{name="{k}"}} {v}' for k, v in sorted(self.read_gauges().items()))
+        lines.append("# TYPE miko_memory_bytes gauge")
+        lines.extend(f'miko_memory_bytes{{kind="{k}"}} {v}' for k, v in sorted(self.memory().items()))
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        def fmt(seconds):
+            return f"{seconds * 1000:.0f}ms"
+
+        lines = ["Handlers (count, p50, p99, max):"]
+        for name, hist in sorted(self.handlers.items()):
+            if hist.count:
+                errors = self.handler_errors.get(name)
+                suffix = f", {errors} errors" if errors else ""
+                lines.append(f"- {name}: {hist.count}, {fmt(hist.quantile(0.5))}, {fmt(hist.quantile(0.99))}, "
+                             f"{fmt(hist.max)}{suffix}")
+        lines.append("Telegram API (count, p50, p99, max):")
+        for name, hist in sorted(self.api.items()):
+            errors = self.api_errors.get(name)
+            suffix = f", {errors} errors" if errors else ""
+            lines.append(f"- {name}: {hist.count}, {fmt(hist.quantile(0.5))}, {fmt(hist.quantile(0.99))}, "
+                         f"{fmt(hist.max)}{suffix}")
+        lines.append(f"FloodWait: {self.flood_waits} times, {self.flood_wait_seconds}s total")
+        lines.append("Gauges:")
+        lines.extend(f"- {k}: {v:g}" for k, v in sorted(self.read_gauges().items()))
+        lines.append("Memory:")
+        lines.extend(f"- {k}: {v / 1048576:.1f} MiB" for k, v in sorted(self.memory().items()))
+        return "\n".join(lines)
+
+    async def run_exporter(self, path: str, interval: float = 30.0):
+        while True:
+            await asyncio.sleep(interval)
+            text = self.render_prometheus()
+            try:
+                await asyncio.to_thread(self._write, path, text)
+            except Exception as e:
+                print(f"Failed to write metrics file: {e}")
+
+    @staticmethod
+    def _write(path: str, text: str):
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp, path)
+
+metrics = Metrics(METRICS_ENABLED)
+
+class StateStore:
+    # Runtime state kept in SQLite (WAL mode) as JSON values in small key/value
+    # tables. put()/delete() only queue the change; a worker thread applies
+    # queued changes in one transaction per batch, so handlers never wait on disk.
+    TABLES = ("sudo", "flows", "usernames", "accounts")
+    _STOP = object()
+
+    def __init__(self, path: str, flush_interval: float = 0.5):
+        self.path = path
+        self.flush_interval = float(flush_interval)
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            for table in self.TABLES:
+                self._conn.execute(f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            self._conn.commit()
+        return self._conn
+
+    def load(self) -> Dict[str, Dict[str, Any]]:
+        # One bulk read of every table; call before the worker thread starts.
+        conn = self._connect()
+        return {table: {key: json.loads(value) for key, value in conn.execute(f"SELECT key, value FROM {table}")}
+                for table in self.TABLES}
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="state-store", daemon=True)
+                self._thread.start()
+
+    def put(self, table: str, key, value):
+        self.start()
+        self._queue.put(("put", table, str(key), json.dumps(value)))
+
+    def delete(self, table: str, key):
+        self.start()
+        self._queue.put(("delete", table, str(key), None))
+
+    def snapshot(self, table: str, items: Dict[Any, Any]):
+        # Replaces the whole table with `items`.
+        self.start()
+        self._queue.put(("snapshot", table, None, [(str(k), json.dumps(v)) for k, v in items.items()]))
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def close(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(self._STOP)
+            thread.join()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _run(self):
+        conn = self._connect()
+        stop = False
+        while not stop:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while batch[-1] is not self._STOP:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            if batch[-1] is self._STOP:
+                batch.pop()
+                stop = True
+            try:
+                with conn:
+                    for op, table, key, value in batch:
+                        if op == "put":
+                            conn.execute(f"INSERT OR REPLACE INTO {table} (key, value) VALUES (?, ?)", (key, value))
+                        elif op == "delete":
+                            conn.execute(f"DELETE FROM {table} WHERE key = ?", (key,))
+                        else:
+                            conn.execute(f"DELETE FROM {table}")
+                            conn.executemany(f"INSERT INTO {table} (key, value) VALUES (?, ?)", value)
+            except Exception as e:
+                print(f"Failed to persist {len(batch)} state changes: {e}")
+
+state_store = StateStore(STATE_DB, STATE_FLUSH_INTERVAL)
+
+class ConversationStore:
+    # Add/delete flow state per user. Entries are kept in last-activity order, so
+    # idle ones are always at the front and each eviction is a single popitem().
+    # on_expire(uid, state, timed_out) is called for every entry dropped by a
+    # timeout (timed_out=True) or because the store is full.
+    def __init__(self, idle_timeout: float = 600, max_size: int = 1000, on_expire=None):
+        self.idle_timeout = float(idle_timeout)
+        self.max_size = max(1, int(max_size))
+        self.on_expire = on_expire
+        self._entries: "OrderedDict[int, list]" = OrderedDict()
+
+    def __contains__(self, uid) -> bool:
+        entry = self._entries.get(uid)
+        if entry is None:
+            return False
+        if time.monotonic() - entry[1] > self.idle_timeout:
+            self.expire()
+            return False
+        return True
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __getitem__(self, uid) -> Dict[str, Any]:
+        state = self.get(uid)
+        if state is None:
+            raise KeyError(uid)
+        return state
+
+    def get(self, uid, default=None):
+        if uid not in self:
+            return default
+        entry = self._entries[uid]
+        entry[1] = time.monotonic()
+        self._entries.move_to_end(uid)
+        return entry[0]
+
+    def __setitem__(self, uid, state: Dict[str, Any]):
+        self._entries[uid] = [state, time.monotonic()]
+        self._entries.move_to_end(uid)
+        self.expire()
+
+    def holds(self, uid, state) -> bool:
+        # True while `state` is still uid's flow (not cancelled, expired or replaced).
+        entry = self._entries.get(uid)
+        return entry is not None and entry[0] is state
+
+    def pop(self, uid, default=None):
+        entry = self._entries.pop(uid, None)
+        return default if entry is None else entry[0]
+
+    def items(self):
+        return [(uid, entry[0]) for uid, entry in self._entries.items()]
+
+    def expire(self):
+        cutoff = time.monotonic() - self.idle_timeout
+        while self._entries:
+            uid, entry = next(iter(self._entries.items()))
+            timed_out = entry[1] <= cutoff
+            if not timed_out and len(self._entries) <= self.max_size:
+                break
+            self._entries.popitem(last=False)
+            if self.on_expire is not None:
+                self.on_expire(uid, entry[0], timed_out)
+
+    async def run(self, interval: float = 30.0):
+        # Sweeps idle flows even when no new messages arrive.
+        while True:
+            await asyncio.sleep(interval)
+            self.expire()
+
+def notify_flow_expired(uid: int, state: Dict[str, Any], timed_out: bool):
+    step = state.get("step", "")
+    flow = "delete-account" if step.startswith("delete") else "add-account"
+    reason = "timed out due to inactivity" if timed_out else "was dropped because too many flows are active"
+    asyncio.create_task(release_flow(state))
+    asyncio.create_task(_send_quietly(uid, f"Your {flow} flow {reason}. Start it again when ready."))
+
+async def _send_quietly(uid: int, text: str):
+    try:
+        await bot.send_message(uid, text)
+    except Exception:
+        pass
+
+user_states = ConversationStore(FLOW_IDLE_TIMEOUT, FLOW_MAX_ACTIVE, on_expire=notify_flow_expired)
+
+def parse_log_timestamp(value: str) -> float:
+    return datetime.strptime(value, SIM_LOG_TS_FORMAT).replace(tzinfo=timezone.utc).timestamp()
+
+class SimLogStats:
+    # Running per-performer / per-action totals plus minute and hour buckets so
+    # windowed counts never touch the log file.
+    WINDOWS = {"hour": 3600, "day": 86400, "week": 604800}
+    MINUTE_BUCKETS = 60
+    HOUR_BUCKETS = 168
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.total = 0
+        self.by_performer = Counter()
+        self.by_action = Counter()
+        self.minutes: Dict[int, tuple] = {}
+        self.hours: Dict[int, tuple] = {}
+
+    def add(self, row_number: int, row, ts: float):
+        action, performer = row[1], row[3]
+        self.total += 1
+        self.by_performer[performer] += 1
+        self.by_action[action] += 1
+        self._bucket(self.minutes, int(ts // 60), self.MINUTE_BUCKETS, action, performer)
+        self._bucket(self.hours, int(ts // 3600), self.HOUR_BUCKETS, action, performer)
+
+    @staticmethod
+    def _bucket(buckets, key, keep, action, performer):
+        bucket = buckets.get(key)
+        if bucket is None:
+            # New buckets appear at most once per bucket width, so pruning here is amortized.
+            for old in [k for k in buckets if k <= key - keep]:
+                del buckets[old]
+            bucket = buckets[key] = (Counter(), Counter())
+        bucket[0][performer] += 1
+        bucket[1][action] += 1
+
+    def counts(self, window: str = None, now: float = None):
+        if window is None:
+            return self.by_performer, self.by_action
+        seconds = self.WINDOWS[window]
+        now = time.time() if now is None else now
+        if seconds <= 3600:
+            buckets, first = self.minutes, int(now // 60) - seconds // 60
+        else:
+            buckets, first = self.hours, int(now // 3600) - seconds // 3600
+        performers, actions = Counter(), Counter()
+        for key, (p, a) in buckets.items():
+            if key > first:
+                performers.update(p)
+                actions.update(a)
+        return performers, actions
+
+    def copy(self) -> "SimLogStats":
+        other = SimLogStats()
+        other.total = self.total
+        other.by_performer = self.by_performer.copy()
+        other.by_action = self.by_action.copy()
+        other.minutes = {k: (p.copy(), a.copy()) for k, (p, a) in self.minutes.items()}
+        other.hours = {k: (p.copy(), a.copy()) for k, (p, a) in self.hours.items()}
+        return other
+
+    def dump(self):
+        return {
+            "total": self.total,
+            "by_performer": dict(self.by_performer),
+            "by_action": dict(self.by_action),
+            "minutes": {k: [dict(p), dict(a)] for k, (p, a) in self.minutes.items()},
+            "hours": {k: [dict(p), dict(a)] for k, (p, a) in self.hours.items()},
+        }
+
+    def load(self, data):
+        self.total = data["total"]
+        self.by_performer = Counter(data["by_performer"])
+        self.by_action = Counter(data["by_action"])
+        self.minutes = {int(k): (Counter(p), Counter(a)) for k, (p, a) in data["minutes"].items()}
+        self.hours = {int(k): (Counter(p), Counter(a)) for k, (p, a) in data["hours"].items()}
+
+class SimLogSearchIndex:
+    # Inverted index from Performed By, Action and Target trigrams to row
+    # numbers. Row numbers only ever grow, so every posting list stays sorted.
+    # It is not checkpointed; each sealed segment's postings are saved once,
+    # next to the segment, and the active segment is replayed at startup.
+    KINDS = ("performers", "actions", "trigrams")
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.performers: Dict[str, array] = {}
+        self.actions: Dict[str, array] = {}
+        self.trigrams: Dict[str, array] = {}
+
+    @staticmethod
+    def target_trigrams(text: str):
+        text = text.lower()
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    def add(self, row_number: int, row, ts: float):
+        self._post(self.performers, row[3], row_number)
+        self._post(self.actions, row[1].lower(), row_number)
+        for gram in self.target_trigrams(row[2]):
+            self._post(self.trigrams, gram, row_number)
+
+    @staticmethod
+    def _post(postings, key, row_number):
+        rows = postings.get(key)
+        if rows is None:
+            rows = postings[key] = array("I")
+        rows.append(row_number)
+
+    def postings(self, performer: str = None, action: str = None, target: str = None):
+        # Returns the posting lists a matching row must appear in, or None if a
+        # filter cannot match anything.
+        lists = []
+        if performer is not None:
+            lists.append(self.performers.get(performer))
+        if action is not None:
+            lists.append(self.actions.get(action.lower()))
+        if target:
+            lists.extend(self.trigrams.get(gram) for gram in self.target_trigrams(target))
+        if any(rows is None for rows in lists):
+            return None
+        return lists
+
+    def segment_view(self):
+        # References to every posting list, cheap enough to take under the
+        # writer's sink lock; save_segment() slices them after it is released.
+        return [(kind, key, rows) for kind in self.KINDS for key, rows in getattr(self, kind).items()]
+
+    @staticmethod
+    def segment_path(store, seg) -> str:
+        return os.path.join(store.segment_dir, seg["file"] + ".postings")
+
+    def save_segment(self, store, seg, view):
+        # Writes the postings of one sealed segment's rows next to it: a JSON
+        # header line listing (kind, key, count), then the row numbers as raw
+        # native-endian uint32s in the same order. Lists only ever grow at the
+        # end, so slicing rows below the segment's end is safe while submit()
+        # keeps appending.
+        lo, hi = seg["first_row"], seg["first_row"] + seg["rows"]
+        lists, parts = [], []
+        for kind, key, rows in view:
+            i = bisect.bisect_left(rows, lo)
+            j = bisect.bisect_left(rows, hi, i)
+            if j > i:
+                lists.append([kind, key, j - i])
+                parts.append(rows[i:j])
+        path = self.segment_path(store, seg)
+        header = {"first_row": lo, "rows": seg["rows"], "itemsize": array("I").itemsize, "lists": lists}
+        with open(path + ".tmp", "wb") as f:
+            f.write(json.dumps(header).encode("utf-8") + b"\n")
+            for part in parts:
+                f.write(part.tobytes())
+        os.replace(path + ".tmp", path)
+
+    def _read_segment(self, path: str, seg) -> bool:
+        if not os.path.isfile(path):
+            return False
+        try:
+            with open(path, "rb") as f:
+                header = json.loads(f.readline())
+                if (header["first_row"], header["rows"], header["itemsize"]) != \
+                        (seg["first_row"], seg["rows"], array("I").itemsize):
+                    return False
+                loaded = []
+                for kind, key, count in header["lists"]:
+                    rows = array("I")
+                    rows.frombytes(f.read(count * rows.itemsize))
+                    if len(rows) != count:
+                        return False
+                    loaded.append((kind, key, rows))
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Ignoring search postings {path}: {e}")
+            return False
+        for kind, key, rows in loaded:
+            postings = getattr(self, kind)
+            if key in postings:
+                postings[key].extend(rows)
+            else:
+                postings[key] = rows
+        return True
+
+    def load_segments(self, store) -> int:
+        # Loads the postings saved for each sealed segment, rebuilding (and
+        # saving) any that are missing, and returns the first row not covered;
+        # the caller replays the active segment from there.
+        covered = 0
+        for seg in store.segments:
+            end = seg["first_row"] + seg["rows"]
+            if not self._read_segment(self.segment_path(store, seg), seg):
+                for n, ts, row in store.iter_rows(from_row=seg["first_row"]):
+                    if n >= end:
+                        break
+                    self.add(n, row, ts)
+                self.save_segment(store, seg, self.segment_view())
+            covered = end
+        return covered
+
+class _BoundedReader(io.RawIOBase):
+    def __init__(self, raw, limit: int):
+        self._raw = raw
+        self._left = limit
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self._left <= 0:
+            return 0
+        n = self._raw.readinto(memoryview(b)[:min(len(b), self._left)])
+        self._left -= n
+        return n
+
+def _row_timestamp(row):
+    if len(row) < 4 or row == SIM_LOG_HEADER:
+        return None
+    try:
+        return parse_log_timestamp(row[0])
+    except ValueError:
+        return None
+
+class SimLogStore:
+    # On-disk layout of the simulated actions log:
+    #   path          the active segment, a plain CSV that rows are appended to
+    #   segment_dir   closed segments, gzip files made of one member per block
+    #                 of block_rows rows so a reader can seek to any block
+    #   index_path    JSON sidecar with each closed segment's time range, first
+    #                 row number and per-block (offset, first timestamp, first row)
+    # The active segment is closed once a row falls into a later segment_seconds
+    # period; a row whose clock stepped back stays in the active segment.
+    # Segment files are named after their period and first row, so they never
+    # collide. Row numbers are global and increase by one per logged row.
+    #
+    # Block timestamps (and segment ends) are the running maximum of the
+    # logged timestamps, so they stay ascending for bisecting even if the
+    # clock steps back; segment starts are the true minimum.
+    def __init__(self, path: str, segment_dir: str, index_path: str, segment_seconds: int = 86400,
+                 block_rows: int = 1000, durability: str = "fsync"):
+        self.path = path
+        self.segment_dir = segment_dir
+        self.index_path = index_path
+        self.segment_seconds = int(segment_seconds)
+        self.block_rows = max(1, int(block_rows))
+        self.durability = durability
+        self.segments = []
+        self._lock = threading.Lock()
+        self._opened = False
+        self._file = None
+        self.last_ts = None
+        self._reset_active(0)
+
+    def _reset_active(self, first_row: int):
+        self.active_first_row = first_row
+        self.active_rows = 0
+        self.active_key = None
+        self.active_start = None
+        self.active_blocks = []
+        self.active_end = 0
+
+    @property
+    def rows_total(self) -> int:
+        return self.active_first_row + self.active_rows
+
+    def open(self):
+        with self._lock:
+            if self._opened:
+                return
+            if os.path.isfile(self.index_path):
+                with open(self.index_path, "r", encoding="utf-8") as f:
+                    self.segments = json.load(f)["segments"]
+            self._recover_segments()
+            first_row = self.segments[-1]["first_row"] + self.segments[-1]["rows"] if self.segments else 0
+            self.last_ts = self.segments[-1]["end"] if self.segments else None
+            self._reset_active(first_row)
+            if os.path.isfile(self.path):
+                self._scan_active()
+            self._opened = True
+
+    def _recover_segments(self):
+        # Finish rotations interrupted between renaming the active file and
+        # writing the index.
+        if not os.path.isdir(self.segment_dir):
+            return
+        indexed = {seg["file"] for seg in self.segments}
+        for name in sorted(os.listdir(self.segment_dir)):
+            if not name.endswith(".csv"):
+                continue
+            raw_path = os.path.join(self.segment_dir, name)
+            if name + ".gz" in indexed:
+                os.remove(raw_path)
+                continue
+            first_row = self.segments[-1]["first_row"] + self.segments[-1]["rows"] if self.segments else 0
+            self._seal(raw_path, first_row)
+
+    def _scan_active(self):
+        offset = 0
+        with open(self.path, "rb") as raw:
+            buffered = io.BufferedReader(raw)
+            line_start = 0
+            pending = b""
+            # Track byte offsets per CSV record; a quoted field may span lines.
+            for line in buffered:
+                if not pending:
+                    line_start = offset
+                offset += len(line)
+                pending += line
+                if pending.count(b'"') % 2:
+                    continue
+                text = pending.decode("utf-8", errors="replace")
+                pending = b""
+                for row in csv.reader([text]):
+                    ts = _row_timestamp(row)
+                    if ts is None:
+                        continue
+                    self._note_active_row(line_start, ts)
+        self.active_end = offset
+
+    def _note_active_row(self, offset: int, ts: float):
+        if self.active_rows == 0:
+            self.active_start = ts
+            self.active_key = int(ts // self.segment_seconds)
+        else:
+            self.active_start = min(self.active_start, ts)
+        self.last_ts = ts if self.last_ts is None else max(self.last_ts, ts)
+        if self.active_rows % self.block_rows == 0:
+            self.active_blocks.append([offset, self.last_ts, self.rows_total])
+        self.active_rows += 1
+
+    def append(self, rows):
+        self.open()
+        with self._lock:
+            for row, ts in rows:
+                if self.active_rows and int(ts // self.segment_seconds) > self.active_key:
+                    self._rotate()
+                if self._file is None:
+                    self._file = open(self.path, "a", newline="", encoding="utf-8")
+                    if self._file.tell() == 0:
+                        csv.writer(self._file).writerow(SIM_LOG_HEADER)
+                offset = self._file.tell() if self.active_rows % self.block_rows == 0 else None
+                csv.writer(self._file).writerow(row)
+                self._note_active_row(offset, ts)
+            if self._file is not None:
+                self._file.flush()
+                if self.durability == "fsync":
+                    os.fsync(self._file.fileno())
+                self.active_end = self._file.tell()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _rotate(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        base = os.path.splitext(os.path.basename(self.path))[0]
+        stamp = time.strftime("%Y%m%dT%H%M%S", time.gmtime(self.active_key * self.segment_seconds))
+        os.makedirs(self.segment_dir, exist_ok=True)
+        raw_path = os.path.join(self.segment_dir, f"{base}-{stamp}-{self.active_first_row}.csv")
+        if os.path.exists(raw_path) or os.path.exists(raw_path + ".gz"):
+            raise RuntimeError(f"segment {raw_path} already exists")
+        os.replace(self.path, raw_path)
+        first_row = self.rows_total
+        self._seal(raw_path, self.active_first_row)
+        self._reset_active(first_row)
+
+    def _seal(self, raw_path: str, first_row: int):
+        gz_path = raw_path + ".gz"
+        if any(seg["file"] == os.path.basename(gz_path) for seg in self.segments):
+            raise RuntimeError(f"segment {gz_path} is already indexed")
+        tmp_path = gz_path + ".tmp"
+        blocks = []
+        rows = 0
+        start = None
+        end = self.segments[-1]["end"] if self.segments else None
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(SIM_LOG_HEADER)
+        with open(raw_path, "r", newline="", encoding="utf-8") as src, open(tmp_path, "wb") as dst:
+            for row in csv.reader(src):
+                ts = _row_timestamp(row)
+                if ts is None:
+                    continue
+                end = ts if end is None else max(end, ts)
+                if rows % self.block_rows == 0:
+                    if rows:
+                        dst.write(gzip.compress(buf.getvalue().encode("utf-8"), mtime=0))
+                        buf.seek(0)
+                        buf.truncate()
+                    blocks.append([dst.tell(), end, first_row + rows])
+                writer.writerow(row)
+                start = ts if start is None else min(start, ts)
+                rows += 1
+            dst.write(gzip.compress(buf.getvalue().encode("utf-8"), mtime=0))
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.replace(tmp_path, gz_path)
+        if rows:
+            self.segments.append({
+                "file": os.path.basename(gz_path),
+                "start": start,
+                "end": end,
+                "first_row": first_row,
+                "rows": rows,
+                "blocks": blocks,
+            })
+            self._save_index()
+        else:
+            os.remove(gz_path)
+        os.remove(raw_path)
+
+    def _save_index(self):
+        tmp = self.index_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"segments": self.segments}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.index_path)
+
+    def iter_rows(self, start_ts: float = None, end_ts: float = None, from_row: int = 0):
+        # Yields (row_number, timestamp, row) in log order, opening only the
+        # segments whose time range overlaps [start_ts, end_ts] and seeking to
+        # the first block that can contain a match.
+        self.open()
+        with self._lock:
+            segments = list(self.segments)
+            active = None
+            if self.active_rows:
+                active = (list(self.active_blocks), self.active_start, self.active_end, open(self.path, "rb"))
+        parts = []
+        for seg in segments:
+            if seg["first_row"] + seg["rows"] <= from_row:
+                continue
+            if (start_ts is not None and seg["end"] < start_ts) or (end_ts is not None and seg["start"] > end_ts):
+                continue
+            parts.append(seg)
+        try:
+            for seg in parts:
+                with open(os.path.join(self.segment_dir, seg["file"]), "rb") as raw:
+                    block = self._first_block(seg["blocks"], start_ts, from_row)
+                    raw.seek(block[0])
+                    stream = io.TextIOWrapper(gzip.GzipFile(fileobj=raw, mode="rb"), encoding="utf-8", newline="")
+                    for item in self._iter_stream(stream, block[2], start_ts, end_ts, from_row):
+                        if item is None:
+                            return
+                        yield item
+            if active is not None:
+                blocks, start, end, raw = active
+                if end_ts is not None and start > end_ts:
+                    return
+                block = self._first_block(blocks, start_ts, from_row)
+                raw.seek(block[0])
+                stream = io.TextIOWrapper(io.BufferedReader(_BoundedReader(raw, end - block[0])),
+                                          encoding="utf-8", newline="")
+                for item in self._iter_stream(stream, block[2], start_ts, end_ts, from_row):
+                    if item is None:
+                        return
+                    yield item
+        finally:
+            if active is not None:
+                active[3].close()
+
+    def row_bounds(self, start_ts: float = None, end_ts: float = None):
+        # Conservative [lo, hi] row numbers that can hold rows inside the time range.
+        self.open()
+        with self._lock:
+            blocks = [b for seg in self.segments for b in seg["blocks"]] + list(self.active_blocks)
+            total = self.rows_total
+        lo, hi = 0, total - 1
+        if start_ts is not None and blocks:
+            i = bisect.bisect_left([b[1] for b in blocks], start_ts) - 1
+            lo = blocks[max(i, 0)][2]
+        if end_ts is not None and blocks:
+            i = bisect.bisect_right([b[1] for b in blocks], end_ts)
+            hi = blocks[i][2] - 1 if i < len(blocks) else total - 1
+        return lo, hi
+
+    def read_rows(self, numbers):
+        # Yields (row_number, timestamp, row) for the given ascending row numbers,
+        # re-seeking whenever the next wanted row is more than a block away.
+        wanted = iter(numbers)
+        target = next(wanted, None)
+        while target is not None:
+            restart = False
+            for n, ts, row in self.iter_rows(from_row=target):
+                if n < target:
+                    continue
+                if n == target:
+                    yield n, ts, row
+                    target = next(wanted, None)
+                    if target is None:
+                        return
+                    if target - n > self.block_rows:
+                        restart = True
+                        break
+            if not restart:
+                return
+
+    @staticmethod
+    def _first_block(blocks, start_ts, from_row):
+        i = bisect.bisect_right([b[2] for b in blocks], from_row) - 1
+        if start_ts is not None:
+            i = max(i, bisect.bisect_left([b[1] for b in blocks], start_ts) - 1)
+        return blocks[max(i, 0)]
+
+    @staticmethod
+    def _iter_stream(stream, row_number, start_ts, end_ts, from_row):
+        # Yields None once end_ts has been passed so callers can stop early.
+        for row in csv.reader(stream):
+            ts = _row_timestamp(row)
+            if ts is None:
+                continue
+            n = row_number
+            row_number += 1
+            if n < from_row or (start_ts is not None and ts < start_ts):
+                continue
+            if end_ts is not None and ts > end_ts:
+                yield None
+                return
+            yield n, ts, row
+
+class SimLogWriter:
+    # Rows are queued by the event loop and written in batches on a worker thread.
+    # A batch is flushed once it holds flush_rows rows or flush_interval seconds
+    # after its first row, whichever comes first. durability is "fsync" (fsync
+    # after every batch) or "none" (leave it to the OS).
+    #
+    # Sinks (e.g. SimLogStats) are updated as rows are submitted. They are
+    # checkpointed together with the row number they cover, so restore() only
+    # has to replay the rows written after the last checkpoint. A checkpoint
+    # only holds the sink lock (and so blocks submit()) while taking copy() of
+    # each sink; dump() and the file write run after it is released.
+    #
+    # Segment sinks (e.g. SimLogSearchIndex) are too large to checkpoint; they
+    # save their state once per sealed segment and replay the active segment.
+    _STOP = object()
+
+    def __init__(self, store: SimLogStore, flush_rows: int = 100, flush_interval: float = 1.0,
+                 checkpoint_path: str = None, checkpoint_interval: float = 60.0, sinks: Dict[str, Any] = None,
+                 segment_sinks: Dict[str, Any] = None):
+        self.store = store
+        self.flush_rows = max(1, int(flush_rows))
+        self.flush_interval = float(flush_interval)
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_interval = float(checkpoint_interval)
+        self.sinks = sinks or {}
+        self.segment_sinks = segment_sinks or {}
+        self._all_sinks = list(self.sinks.values()) + list(self.segment_sinks.values())
+        self.next_row = None
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._sink_lock = threading.Lock()
+        self._last_checkpoint = time.monotonic()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="sim-log-writer", daemon=True)
+                self._thread.start()
+
+    def submit(self, row, ts: float):
+        self.start()
+        with self._sink_lock:
+            if self.next_row is None:
+                self.store.open()
+                self.next_row = self.store.rows_total
+            for sink in self._all_sinks:
+                sink.add(self.next_row, row, ts)
+            self.next_row += 1
+            self._queue.put((row, ts))
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def flush(self):
+        # Blocks until every row submitted before the call is written.
+        if self._thread is None:
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait()
+
+    def close(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        self._queue.put(self._STOP)
+        thread.join()
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch = []
+            waiters = []
+            item = self._queue.get()
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                if item is self._STOP:
+                    stop = True
+                    break
+                if isinstance(item, threading.Event):
+                    waiters.append(item)
+                    break
+                batch.append(item)
+                if len(batch) >= self.flush_rows:
+                    break
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+            if batch:
+                sealed = len(self.store.segments)
+                self._write(batch, stop)
+                for seg in self.store.segments[sealed:]:
+                    self._save_segment(seg)
+            if stop or (batch and time.monotonic() - self._last_checkpoint >= self.checkpoint_interval):
+                self._checkpoint()
+            for w in waiters:
+                w.set()
+        self.store.close()
+
+    def _checkpoint(self):
+        if not self.checkpoint_path or self.next_row is None:
+            return
+        with self._sink_lock:
+            # Only consistent while nothing is queued: the sinks already count
+            # queued rows that are not in the log yet.
+            if not self._queue.empty() or self.next_row != self.store.rows_total:
+                return
+            row = self.next_row
+            copies = {name: sink.copy() for name, sink in self.sinks.items()}
+        tmp = self.checkpoint_path + ".tmp"
+        try:
+            data = {"row": row, "sinks": {name: sink.dump() for name, sink in copies.items()}}
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(tmp, self.checkpoint_path)
+            self._last_checkpoint = time.monotonic()
+        except Exception as e:
+            print(f"Failed to write simulated log checkpoint: {e}")
+
+    def _write(self, batch, stopping: bool):
+        # The sinks already count these rows under their row numbers, so a
+        # failed batch is retried (resuming after any rows that did get written)
+        # rather than dropped. Only when stopping does it give up; the log and
+        # sinks then disagree, no checkpoint is written, and restore() at the
+        # next start recounts from the log.
+        attempt = 0
+        while True:
+            before = self.store.rows_total
+            try:
+                self.store.append(batch)
+                return
+            except Exception as e:
+                batch = batch[self.store.rows_total - before:]
+                attempt += 1
+                if stopping and attempt >= 3:
+                    print(f"Dropping {len(batch)} simulated log rows after {attempt} failed writes: {e}")
+                    return
+                delay = min(30.0, 2.0 ** (attempt - 1))
+                print(f"Failed to write {len(batch)} simulated log rows, retrying in {delay:.0f}s: {e}")
+                time.sleep(delay)
+
+    def _save_segment(self, seg):
+        for name, sink in self.segment_sinks.items():
+            with self._sink_lock:
+                view = sink.segment_view()
+            try:
+                sink.save_segment(self.store, seg, view)
+            except Exception as e:
+                # Rebuilt from the segment at the next startup.
+                print(f"Failed to save {name} for {seg['file']}: {e}")
+
+    def restore(self):
+        # Load the last checkpoint and replay the rows logged after it. Falls
+        # back to a full replay when the checkpoint is missing or does not match the log.
+        # Segment sinks load their per-segment files and replay the active segment.
+        self.store.open()
+        for sink in self._all_sinks:
+            sink.reset()
+        from_row = 0
+        if self.checkpoint_path and os.path.isfile(self.checkpoint_path):
+            try:
+                with open(self.checkpoint_path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                if data["row"] > self.store.rows_total:
+                    raise ValueError("checkpoint is ahead of the log")
+                for name, sink in self.sinks.items():
+                    sink.load(data["sinks"][name])
+                from_row = data["row"]
+            except Exception as e:
+                print(f"Ignoring simulated log checkpoint: {e}")
+                for sink in self.sinks.values():
+                    sink.reset()
+                from_row = 0
+        starts = [(sink, from_row) for sink in self.sinks.values()]
+        starts.extend((sink, sink.load_segments(self.store)) for sink in self.segment_sinks.values())
+        replayed = 0
+        for n, ts, row in self.store.iter_rows(from_row=min((start for _, start in starts), default=from_row)):
+            for sink, start in starts:
+                if n >= start:
+                    sink.add(n, row, ts)
+            replayed += 1
+        with self._sink_lock:
+            self.next_row = self.store.rows_total
+        return replayed
+
+sim_log_stats = SimLogStats()
+sim_log_search = SimLogSearchIndex()
+sim_log_store = SimLogStore(SIM_LOG_FILE, SIM_LOG_SEGMENT_DIR, SIM_LOG_INDEX, SIM_LOG_SEGMENT_SECONDS,
+                            SIM_LOG_BLOCK_ROWS, SIM_LOG_DURABILITY)
+sim_log = SimLogWriter(sim_log_store, SIM_LOG_FLUSH_ROWS, SIM_LOG_FLUSH_INTERVAL,
+                       checkpoint_path=SIM_LOG_CHECKPOINT, checkpoint_interval=SIM_LOG_CHECKPOINT_INTERVAL,
+                       sinks={"stats": sim_log_stats}, segment_sinks={"search": sim_log_search})
+
+def log_simulated_action(action: str, target: str, performed_by: str, details: str = ""):
+    ts = time.time()
+    sim_log.submit([time.strftime(SIM_LOG_TS_FORMAT, time.gmtime(ts)), action, target, performed_by, details], ts)
+
+def _parse_search_time(value: str) -> float:
+    m = re.fullmatch(r"(\d+)([smhdw])", value.lower())
+    if m:
+        units = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+        return time.time() - int(m.group(1)) * units[m.group(2)]
+    return datetime.fromisoformat(value).replace(tzinfo=timezone.utc).timestamp()
+
+def parse_log_search_args(text: str) -> Dict[str, Any]:
+    query = {"performer": None, "action": None, "target": None, "start": None, "end": None}
+    for token in shlex.split(text):
+        key, sep, value = token.partition("=")
+        if not sep or not value:
+            raise ValueError(f"Expected key=value, got '{token}'")
+        key = key.lower()
+        if key in ("by", "performer"):
+            query["performer"] = value
+        elif key == "action":
+            query["action"] = value
+        elif key == "target":
+            query["target"] = value
+        elif key in ("since", "from"):
+            query["start"] = _parse_search_time(value)
+        elif key in ("until", "to"):
+            query["end"] = _parse_search_time(value)
+        else:
+            raise ValueError(f"Unknown filter '{key}'")
+    return query
+
+def log_row_matches(query: Dict[str, Any], row) -> bool:
+    # Content filters only; time ranges are applied by iter_rows().
+    if query["performer"] is not None and row[3] != query["performer"]:
+        return False
+    if query["action"] is not None and row[1].lower() != query["action"].lower():
+        return False
+    if query["target"] and query["target"].lower() not in row[2].lower():
+        return False
+    return True
+
+def _scan_log_backwards(query: Dict[str, Any], lo: int, hi: int, want: int):
+    # Newest-first matches in rows [lo, hi], found by streaming windows of
+    # whole blocks forward with iter_rows() (one seek and one pass of
+    # decompression each) and stepping back a growing window at a time.
+    results = []
+    window = sim_log_store.block_rows * 4
+    while hi >= lo and len(results) < want:
+        start = max(lo, hi - window + 1)
+        found = []
+        for n, ts, row in sim_log_store.iter_rows(query["start"], query["end"], from_row=start):
+            if n > hi:
+                break
+            if log_row_matches(query, row):
+                found.append((n, row))
+        results.extend(reversed(found))
+        hi = start - 1
+        window = min(window * 2, sim_log_store.block_rows * 64)
+    return results[:want]
+
+def search_log(query: Dict[str, Any], cursor: int, limit: int):
+    # Returns up to `limit` matching rows, newest first, starting at row number
+    # `cursor` and walking backwards, plus the cursor for the following page
+    # (None when there is nothing older). Runs in a worker thread.
+    lists = sim_log_search.postings(query["performer"], query["action"], query["target"])
+    if lists is None:
+        return [], None
+    lo, hi = sim_log_store.row_bounds(query["start"], query["end"])
+    hi = min(hi, cursor)
+    want = limit + 1
+    candidates = None
+    if lists:
+        lists.sort(key=len)
+        driver, others = lists[0], lists[1:]
+
+        def intersect():
+            i = bisect.bisect_right(driver, hi) - 1
+            while i >= 0 and driver[i] >= lo:
+                n = driver[i]
+                i -= 1
+                if all((j := bisect.bisect_left(rows, n)) < len(rows) and rows[j] == n for rows in others):
+                    yield n
+        # Fetching candidates one by one pays a seek and a block decompression
+        # each, so it only wins while there are fewer candidates than blocks.
+        threshold = (hi - lo + 1) // sim_log_store.block_rows + want
+        candidates = list(itertools.islice(intersect(), threshold))
+        if len(candidates) >= threshold:
+            candidates = None
+    if candidates is None:
+        matches = _scan_log_backwards(query, lo, hi, want)
+    else:
+        matches = []
+        for start in range(0, len(candidates), max(want * 2, 20)):
+            chunk = candidates[start:start + max(want * 2, 20)]
+            rows = {n: (ts, row) for n, ts, row in sim_log_store.read_rows(sorted(chunk))}
+            for n in chunk:
+                if n not in rows:
+                    continue
+                ts, row = rows[n]
+                if query["start"] is not None and ts < query["start"]:
+                    continue
+                if query["end"] is not None and ts > query["end"]:
+                    continue
+                if log_row_matches(query, row):
+                    matches.append((n, row))
+            if len(matches) >= want:
+                break
+        matches = matches[:want]
+    # The extra match only tells whether an older page exists.
+    if len(matches) > limit:
+        return matches[:limit], matches[limit - 1][0] - 1
+    return matches, None
+
+def export_log(query: Dict[str, Any], path: str) -> int:
+    # Streams matching rows into a gzip-compressed CSV at `path`; runs in a worker thread.
+    count = 0
+    with gzip.open(path, "wt", encoding="utf-8", newline="") as out:
+        writer = csv.writer(out)
+        writer.writerow(SIM_LOG_HEADER)
+        for _, _, row in sim_log_store.iter_rows(query["start"], query["end"]):
+            if not log_row_matches(query, row):
+                continue
+            writer.writerow(row)
+            count += 1
+    return count
+
+def format_log_rows(rows) -> str:
+    lines = []
+    for n, row in rows:
+        details = f" ({row[4]})" if len(row) > 4 and row[4] else ""
+        lines.append(f"#{n} {row[0]} {row[1]} \"{row[2]}\" by {row[3]}{details}")
+    return "\n".join(lines)
+
+sim_log_ready = asyncio.Event()
+log_searches: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+async def show_log_search_page(event, token: str, page: int, edit: bool = False):
+    search = log_searches.get(token)
+    if search is None or page >= len(search["pages"]):
+        reply(event, "This search has expired; run /log_search again.")
+        return
+    log_searches.move_to_end(token)
+    rows, next_cursor = await asyncio.to_thread(search_log, search["query"], search["pages"][page], LOG_SEARCH_PAGE_SIZE)
+    if next_cursor is not None and len(search["pages"]) == page + 1:
+        search["pages"].append(next_cursor)
+    nav = []
+    if page > 0:
+        nav.append(Button.inline("Newer", data=f"ls:{token}:{page - 1}"))
+    if next_cursor is not None:
+        nav.append(Button.inline("Older", data=f"ls:{token}:{page + 1}"))
+    text = f"Log search results (page {page + 1}):\n" + format_log_rows(rows) if rows else "No matching log entries."
+    buttons = [nav] if nav else None
+    if edit:
+        await event.edit(text, buttons=buttons)
+    else:
+        reply(event, text, buttons=buttons)
+
+class SudoScheduler:
+    # Expiry deadlines live in a min-heap keyed on time.monotonic(), so the
+    # runner sleeps exactly until the next expiry and wall-clock changes cannot
+    # move it. Re-grants and removals leave stale heap entries behind; they are
+    # skipped when they reach the top.
+    def __init__(self, approved: Dict[int, datetime], notify_concurrency: int = 10, store: StateStore = None):
+        self.approved = approved
+        self.notify_concurrency = max(1, int(notify_concurrency))
+        self.store = store
+        self._deadlines: Dict[int, float] = {}
+        self._heap = []
+        self._wakeup = asyncio.Event()
+
+    def grant(self, uid: int, seconds: int) -> datetime:
+        deadline = time.monotonic() + seconds
+        expiry = datetime.utcnow() + timedelta(seconds=seconds)
+        self.approved[uid] = expiry
+        self._deadlines[uid] = deadline
+        heapq.heappush(self._heap, (deadline, uid))
+        self._wakeup.set()
+        if self.store is not None:
+            self.store.put("sudo", uid, time.time() + seconds)
+        return expiry
+
+    def revoke(self, uid: int) -> bool:
+        self._deadlines.pop(uid, None)
+        if len(self._heap) > 2 * len(self._deadlines) + 64:
+            self._heap = [(d, u) for d, u in self._heap if self._deadlines.get(u) == d]
+            heapq.heapify(self._heap)
+        if self.store is not None:
+            self.store.delete("sudo", uid)
+        return self.approved.pop(uid, None) is not None
+
+    def is_approved(self, uid: int) -> bool:
+        deadline = self._deadlines.get(uid)
+        return deadline is not None and time.monotonic() < deadline
+
+    def dump(self) -> Dict[int, float]:
+        # Wall-clock expiry per user, for persistence.
+        now_wall, now = time.time(), time.monotonic()
+        return {uid: now_wall + deadline - now for uid, deadline in self._deadlines.items()}
+
+    def _pop_expired(self):
+        now = time.monotonic()
+        expired = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, uid = heapq.heappop(self._heap)
+            if self._deadlines.get(uid) == deadline:
+                del self._deadlines[uid]
+                self.approved.pop(uid, None)
+                if self.store is not None:
+                    self.store.delete("sudo", uid)
+                expired.append(uid)
+        return expired
+
+    async def run(self):
+        while True:
+            self._wakeup.clear()
+            expired = self._pop_expired()
+            if expired:
+                asyncio.create_task(self._notify(expired))
+            timeout = max(0.0, self._heap[0][0] - time.monotonic()) if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _notify(self, uids):
+        limit = asyncio.Semaphore(self.notify_concurrency)
+
+        async def notify_one(uid):
+            async with limit:
+                try:
+                    with metrics.api_call("SendMessageRequest"):
+                        await bot.send_message(uid, "Your sudo approval has expired.")
+                except Exception:
+                    pass
+
+        await asyncio.gather(*(notify_one(uid) for uid in uids))
+
+sudo_scheduler = SudoScheduler(SUDO_APPROVED_USERS, SUDO_NOTIFY_CONCURRENCY, state_store)
+
+def split_message(text: str, limit: int = MESSAGE_LIMIT):
+    # Splits at line boundaries; only a single line longer than `limit` is cut mid-line.
+    if len(text) <= limit:
+        return [text]
+    chunks = []
+    current = []
+    size = 0
+    for line in text.split("\n"):
+        while len(line) > limit:
+            if current:
+                chunks.append("\n".join(current))
+                current, size = [], 0
+            chunks.append(line[:limit])
+            line = line[limit:]
+        extra = len(line) + (1 if current else 0)
+        if current and size + extra > limit:
+            chunks.append("\n".join(current))
+            current, size, extra = [], 0, len(line)
+        current.append(line)
+        size += extra
+    if current:
+        chunks.append("\n".join(current))
+    return [c for c in chunks if c.strip()]
+
+class Outbox:
+    # Outgoing bot replies, queued per chat and drained by one task per chat.
+    # Sends to a chat are at least min_interval apart; text-only replies queued
+    # within coalesce_window of each other are merged into one message, and
+    # anything over Telegram's length limit is split. A reply that hits
+    # FloodWaitError goes back to the front of its queue until the wait is over.
+    def __init__(self, min_interval: float = 1.0, coalesce_window: float = 0.1, limit: int = MESSAGE_LIMIT):
+        self.min_interval = float(min_interval)
+        self.coalesce_window = float(coalesce_window)
+        self.limit = limit
+        self._queues: Dict[int, deque] = {}
+        self._workers: Dict[int, asyncio.Task] = {}
+
+    def send(self, chat_id: int, text: str, buttons=None):
+        q = self._queues.get(chat_id)
+        if q is None:
+            q = self._queues[chat_id] = deque()
+        q.append((text, buttons))
+        if chat_id not in self._workers:
+            self._workers[chat_id] = asyncio.create_task(self._drain(chat_id, q))
+
+    def pending(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+
+    async def _drain(self, chat_id: int, q: deque):
+        next_send = time.monotonic() + self.coalesce_window
+        try:
+            while q:
+                wait = next_send - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                text, buttons = q.popleft()
+                while buttons is None and q and q[0][1] is None and len(text) + 2 + len(q[0][0]) <= self.limit:
+                    text += "\n\n" + q.popleft()[0]
+                chunks = split_message(text, self.limit)
+                for i, chunk in enumerate(chunks):
+                    last = i == len(chunks) - 1
+                    try:
+                        with metrics.api_call("SendMessageRequest"):
+                            await bot.send_message(chat_id, chunk, buttons=buttons if last else None)
+                    except FloodWaitError as e:
+                        rest = [(c, None) for c in chunks[i:-1]] + [(chunks[-1], buttons)]
+                        q.extendleft(reversed(rest))
+                        next_send = time.monotonic() + e.seconds
+                        break
+                    except Exception as e:
+                        print(f"Failed to send reply to {chat_id}: {e}")
+                    next_send = time.monotonic() + self.min_interval
+                    if not last:
+                        await asyncio.sleep(self.min_interval)
+            # Linger until the rate limit has passed so a quick follow-up still respects it.
+            wait = next_send - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+        finally:
+            self._workers.pop(chat_id, None)
+            if not q:
+                self._queues.pop(chat_id, None)
+            else:
+                self._workers[chat_id] = asyncio.create_task(self._drain(chat_id, q))
+
+outbox = Outbox(REPLY_MIN_INTERVAL, REPLY_COALESCE_WINDOW)
+
+def reply(event, text: str, buttons=None):
+    outbox.send(event.chat_id, text, buttons)
+
+def format_accounts(title: str) -> str:
+    lines = [f"{title}:"]
+    for a in ACCOUNT_DETAILS:
+        proxy = a.get("proxy")
+        ps = "no proxy" if not proxy else f"{proxy.get('ip')}:{proxy.get('port')}"
+        lines.append(f"- {a.get('phone')} (session: {a.get('session')}) [{ps}] {session_status(a.get('phone'))}")
+    return "\n".join(lines)
+
+POLICY_OPEN = "open"
+POLICY_STAFF = "staff"
+POLICY_ADMIN = "admin"
+
+class AdmissionRejected(Exception):
+    pass
+
+class AdmissionGate:
+    # Concurrency budget for one class of expensive commands: at most `limit`
+    # run at once and at most `queue_size` wait; anyone beyond that is rejected
+    # immediately instead of piling up.
+    def __init__(self, name: str, limit: int, queue_size: int):
+        self.name = name
+        self.limit = max(1, int(limit))
+        self.queue_size = max(0, int(queue_size))
+        self._slots = asyncio.Semaphore(self.limit)
+        self.running = 0
+        self.waiting = 0
+        self.rejected = 0
+
+    @contextlib.asynccontextmanager
+    async def admit(self):
+        if self._slots.locked() and self.waiting >= self.queue_size:
+            self.rejected += 1
+            raise AdmissionRejected(self.name)
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        self.running += 1
+        try:
+            yield
+        finally:
+            self.running -= 1
+            self._slots.release()
+
+ADMISSION_GATES = {name: AdmissionGate(name, limit, queue_size)
+                   for name, (limit, queue_size) in ADMISSION_LIMITS.items()}
+
+CommandSpec = namedtuple("CommandSpec", "handler policy denied gate inline")
+CallbackSpec = namedtuple("CallbackSpec", "handler policy gate")
+
+COMMANDS: Dict[str, CommandSpec] = {}
+CALLBACKS: Dict[str, CallbackSpec] = {}
+
+def is_authorized(uid: int, policy: str) -> bool:
+    if policy == POLICY_OPEN or uid in ADMIN_IDS:
+        return True
+    return policy == POLICY_STAFF and sudo_scheduler.is_approved(uid)
+
+def command(name: str, policy: str = POLICY_ADMIN, denied: str = "Not authorized.", gate: str = None,
+            inline: bool = False):
+    # gate names an ADMISSION_GATES entry. inline commands are cheap and run as
+    # soon as they arrive, skipping the per-user queue and admission control.
+    # /cancel is inline too, so generic_flow re-checks user_states.holds()
+    # after every await instead of assuming its step still owns the flow.
+    def register(handler):
+        COMMANDS[name] = CommandSpec(metrics.timed(handler), policy, denied,
+                                     ADMISSION_GATES[gate] if gate else None, inline)
+        return handler
+    return register
+
+def callback(key: str, policy: str = POLICY_STAFF, gate: str = None):
+    # Callback data is "<key>" or "<key>:<args>".
+    def register(handler):
+        CALLBACKS[key] = CallbackSpec(metrics.timed(handler), policy, ADMISSION_GATES[gate] if gate else None)
+        return handler
+    return register
+
+async def run_admitted(gate: Optional[AdmissionGate], event, handler, *args):
+    if gate is None:
+        await handler(event, *args)
+        return
+    try:
+        async with gate.admit():
+            await handler(event, *args)
+    except AdmissionRejected:
+        reply(event, "The bot is busy with other requests like this one; please retry in a moment.")
+
+class SessionManager:
+    # Tracks every account client this process has connected, so abandoned
+    # add-account clients can be closed and shutdown can close all of them at once.
+    def __init__(self):
+        self._open = set()
+
+    def __len__(self) -> int:
+        return len(self._open)
+
+    async def open(self, session: str, api_id: int, api_hash: str, proxy=None) -> TelegramClient:
+        client = TelegramClient(session, api_id, api_hash, proxy=proxy)
+        await client.connect()
+        self._open.add(client)
+        return client
+
+    def track(self, client: TelegramClient):
+        self._open.add(client)
+
+    async def close(self, client: TelegramClient):
+        self._open.discard(client)
+        try:
+            await client.disconnect()
+        except Exception:
+            pass
+
+    async def close_all(self):
+        await asyncio.gather(*(self.close(client) for client in list(self._open)))
+
+session_manager = SessionManager()
+
+async def release_flow(state: Dict[str, Any]):
+    # Undo the side effects of an unfinished add-account flow.
+    client = state.pop("_client", None)
+    if client is not None:
+        await session_manager.close(client)
+    new_acc = state.get("new_account")
+    if state.get("step") == "add_verification_code" and new_acc in ACCOUNT_DETAILS:
+        ACCOUNT_DETAILS.remove(new_acc)
+
+def pending_accounts():
+    # Accounts an add flow has listed in ACCOUNT_DETAILS but not signed in yet.
+    return [state["new_account"] for _, state in user_states.items()
+            if state.get("step") == "add_verification_code" and "new_account" in state]
+
+async def begin_flow(uid: int, step: str):
+    previous = user_states.pop(uid, None)
+    if previous is not None:
+        await release_flow(previous)
+    user_states[uid] = {"step": step}
+
+class ReportingSession:
+    # A configured account whose client only connects on first use. state is
+    # "idle", "connecting", "ready" or "failed" (see error); a failed session is
+    # retried on use once its backoff (doubling per failure) has passed, and
+    # fails fast until then.
+    def __init__(self, account, client: TelegramClient = None):
+        self.account = account
+        self.client = client or self._build_client(account)
+        self.state = "ready" if client is not None else "idle"
+        self.error = None
+        self.failures = 0
+        self.retry_at = 0.0
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def _build_client(acc) -> TelegramClient:
+        phone = acc.get("phone")
+        proxy = acc.get("proxy")
+        proxy_settings = None
+        if proxy:
+            proxy_settings = {
+                "proxy_type": "http",
+                "addr": proxy.get("ip"),
+                "port": proxy.get("port"),
+                "username": proxy.get("username"),
+                "password": proxy.get("password"),
+                "rdns": True
+            }
+        return TelegramClient(acc.get("session", f"session_{phone}"), acc.get("api_id"), acc.get("api_hash"),
+                              proxy=proxy_settings)
+
+    @property
+    def phone(self):
+        return self.account.get("phone")
+
+    async def ensure(self) -> TelegramClient:
+        if self.state == "ready":
+            return self.client
+        self._check_backoff()
+        async with self._lock:
+            if self.state == "ready":
+                return self.client
+            self._check_backoff()
+            self.state = "connecting"
+            started = time.perf_counter()
+            try:
+                await self.client.connect()
+                if not await self.client.is_user_authorized():
+                    raise RuntimeError("session is not authorized; log in once with this session file")
+            except Exception as e:
+                # Leave nothing connected; the retry after the backoff reconnects from scratch.
+                with contextlib.suppress(Exception):
+                    await self.client.disconnect()
+                self.state = "failed"
+                self.error = str(e)
+                self.failures += 1
+                self.retry_at = time.monotonic() + min(SESSION_RETRY_MAX,
+                                                       SESSION_RETRY_BACKOFF * 2 ** (self.failures - 1))
+                print(f"Failed to connect client for {self.phone}: {e}")
+                raise
+            session_manager.track(self.client)
+            self.state = "ready"
+            self.error = None
+            self.failures = 0
+            print(f"Connected client for {self.phone} in {time.perf_counter() - started:.2f}s")
+            return self.client
+
+    @property
+    def backing_off(self) -> bool:
+        return self.state == "failed" and time.monotonic() < self.retry_at
+
+    def _check_backoff(self):
+        if self.backing_off:
+            raise RuntimeError(f"{self.error} (retrying in {self.retry_at - time.monotonic():.0f}s)")
+
+    async def disconnect(self):
+        await session_manager.close(self.client)
+        self.state = "idle"
+
+def session_status(phone: str) -> str:
+    for session in reporting_clients:
+        if session.phone == phone:
+            return session.state if session.state != "failed" else f"failed: {session.error}"
+    return "not loaded"
+
+async def first_ready_session() -> ReportingSession:
+    # The first session that connects, trying connected ones first, then idle
+    # ones, then failed ones (which fail fast while backing off); raises the
+    # last error if none do.
+    if not reporting_clients:
+        raise RuntimeError("no accounts configured")
+    error = None
+    order = {"ready": 0, "connecting": 1, "idle": 1, "failed": 2}
+    for session in sorted(reporting_clients, key=lambda s: order[s.state]):
+        try:
+            await session.ensure()
+            return session
+        except Exception as e:
+            error = e
+    raise error
+
+class StartupTimer:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = []
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - started))
+
+    def report(self) -> str:
+        parts = [f"{name} {seconds:.2f}s" for name, seconds in self.phases]
+        return f"Startup took {time.perf_counter() - self.started:.2f}s (" + ", ".join(parts) + ")"
+
+class LoopWatchdog:
+    # A heartbeat task on the loop records when it last ran; a watcher thread
+    # notices when it has not run for `threshold` seconds and prints what the
+    # loop thread is executing right then, i.e. the code blocking the loop.
+    def __init__(self, threshold: float = 0.5, interval: float = 0.1):
+        self.threshold = float(threshold)
+        self.interval = float(interval)
+        self.lag = Histogram()
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.stalls = 0
+        self._beat = time.monotonic()
+        self._loop = None
+        self._loop_thread = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._task = None
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._task = asyncio.create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+
+    async def _heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self._beat = now
+            lag = max(0.0, now - expected)
+            self.last_lag = lag
+            self.lag.observe(lag)
+            if lag > self.max_lag:
+                self.max_lag = lag
+            if lag >= self.threshold:
+                print(f"Event loop was blocked for {lag:.3f}s")
 
-async def scan_users(event, client: TelegramClient):
+    def _watch(self):
+        reported = None
+        while not self._stop.wait(self.interval / 2):
+            beat = self._beat
+            stalled = time.monotonic() - beat
+            if stalled < self.threshold or beat == reported:
+                continue
+            # One stack dump per stall; the heartbeat logs the total when it ends.
+            reported = beat
+            self.stalls += 1
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            try:
+                task = asyncio.current_task(self._loop)
+            except RuntimeError:
+                task = None
+            where = f" in task {task.get_name()}" if task is not None else ""
+            stack = "".join(traceback.format_stack(frame))
+            print(f"Event loop blocked for {stalled:.3f}s{where}; loop thread stack:\n{stack}", end="")
+
+def run_event_loop(coro):
+    # Prefer uvloop when enabled and installed, otherwise the default asyncio loop.
+    if USE_UVLOOP:
+        try:
+            import uvloop
+        except ImportError:
+            print("uvloop is not installed; using the default asyncio event loop.")
+        else:
+            print(f"Using uvloop {uvloop.__version__} event loop.")
+            return uvloop.run(coro)
+    return asyncio.run(coro)
+
+loop_watchdog = LoopWatchdog(LOOP_LAG_THRESHOLD or 0.5, LOOP_WATCHDOG_INTERVAL)
+
+class UsernameResolver:
+    # LRU cache of (account phone, lowercase username) -> user id, or None for
+    # usernames the account could not resolve (kept for negative_ttl seconds).
+    # Concurrent lookups of the same key share one ResolveUsernameRequest.
+    def __init__(self, max_size: int = 5000, ttl: float = 3600, negative_ttl: float = 300):
+        self.max_size = max(1, int(max_size))
+        self.ttl = float(ttl)
+        self.negative_ttl = float(negative_ttl)
+        self._cache: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._inflight: Dict[tuple, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _key(account, username: str):
+        return account.get("phone"), username.lower()
+
+    def put(self, account, username: str, user_id: Optional[int]):
+        key = self._key(account, username)
+        ttl = self.ttl if user_id is not None else self.negative_ttl
+        self._cache[key] = (user_id, time.monotonic() + ttl)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+            self.evictions += 1
+
+    def dump(self):
+        now_wall, now = time.time(), time.monotonic()
+        return [(phone, username, user_id, now_wall + expires - now)
+                for (phone, username), (user_id, expires) in self._cache.items() if expires > now]
+
+    def load(self, entries):
+        now_wall, now = time.time(), time.monotonic()
+        for phone, username, user_id, expires in entries:
+            if expires > now_wall:
+                self._cache[(phone, username)] = (user_id, now + expires - now_wall)
+                self._cache.move_to_end((phone, username))
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self._cache), "hits": self.hits, "misses": self.misses,
+                "coalesced": self.coalesced, "evictions": self.evictions}
+
+    async def resolve(self, client: TelegramClient, account, username: str) -> Optional[int]:
+        key = self._key(account, username)
+        entry = self._cache.get(key)
+        if entry is not None:
+            if entry[1] > time.monotonic():
+                self.hits += 1
+                self._cache.move_to_end(key)
+                return entry[0]
+            del self._cache[key]
+        pending = self._inflight.get(key)
+        if pending is not None:
+            self.coalesced += 1
+            return await asyncio.shield(pending)
+        self.misses += 1
+        pending = self._inflight[key] = asyncio.get_running_loop().create_future()
+        try:
+            try:
+                with metrics.api_call("ResolveUsernameRequest"):
+                    result = await client(ResolveUsernameRequest(username))
+                user_id = None
+                for u in result.users:
+                    if getattr(u, "username", None) and u.username.lower() == key[1]:
+                        user_id = u.id
+                        break
+            except (UsernameNotOccupiedError, UsernameInvalidError):
+                user_id = None
+            self.put(account, username, user_id)
+            pending.set_result(user_id)
+            return user_id
+        except BaseException as e:
+            pending.set_exception(e)
+            # Mark the exception retrieved; waiters (if any) still receive it.
+            pending.exception()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+username_cache = UsernameResolver(USERNAME_CACHE_SIZE, USERNAME_CACHE_TTL, USERNAME_NEGATIVE_TTL)
+
+async def resolve_target(event, target: str) -> Optional[int]:
+    # Parses a user id or @username argument; responds and returns None on failure.
+    if not target.startswith("@"):
+        try:
+            return int(target)
+        except ValueError:
+            reply(event, "Invalid target. Provide a user ID or @username.")
+            return None
+    if not reporting_clients:
+        reply(event, "No accounts available to resolve username; please provide a user ID.")
+        return None
+    uname = target.lstrip("@")
+    try:
+        session = await first_ready_session()
+        target_id = await username_cache.resolve(session.client, session.account, uname)
+    except Exception as e:
+        reply(event, f"Error resolving username: {e}")
+        return None
+    if target_id is None:
+        reply(event, f"Could not resolve @{uname}.")
+    return target_id
+
+async def scan_users(event, client: TelegramClient, account):
     try:
         chat = await event.get_chat()
         if not hasattr(chat, "id"):
-            await event.respond("This command can only be used in a group or channel.")
+            reply(event, "This command can only be used in a group or channel.")
             return
-        participants = await client(GetParticipantsRequest(
-            channel=chat.id,
-            filter=ChannelParticipantsRecent(),
-            offset=0,
-            limit=200,
-            hash=0
-        ))
+        with metrics.api_call("GetParticipantsRequest"):
+            participants = await client(GetParticipantsRequest(
+                channel=chat.id,
+                filter=ChannelParticipantsRecent(),
+                offset=0,
+                limit=200,
+                hash=0
+            ))
         count = 0
         for u in participants.users:
             if getattr(u, "username", None):
-                username_to_id[u.username.lower()] = u.id
+                username_cache.put(account, u.username, u.id)
                 count += 1
-        await event.respond(f"Scanned and mapped {count} usernames from this chat.")
+        reply(event, f"Scanned and mapped {count} usernames from this chat.")
     except Exception as e:
-        await event.respond(f"Error scanning users: {e}")
+        reply(event, f"Error scanning users: {e}")
 
+@command("resolve", gate="api")
 async def resolve_user(event):
-    if event.sender_id not in ADMIN_IDS:
-        await event.respond("You are not authorized to use this command.")
-        return
     args = event.message.message.split()
     if len(args) < 2:
-        await event.respond("Usage: /resolve @username")
+        reply(event, "Usage: /resolve @username")
         return
     username = args[1].lstrip("@")
     response_lines = []
-    for client, account in reporting_clients:
+    for session in list(reporting_clients):
+        account = session.account
         try:
-            result = await client(ResolveUsernameRequest(username))
-            found_any = False
-            for u in result.users:
-                if getattr(u, "username", None) and u.username.lower() == username.lower():
-                    response_lines.append(f"{account['phone']}: accessible (id={u.id})")
-                    username_to_id[username.lower()] = u.id
-                    found_any = True
-                    break
-            if not found_any:
+            client = await session.ensure()
+            user_id = await username_cache.resolve(client, account, username)
+            if user_id is not None:
+                response_lines.append(f"{account['phone']}: accessible (id={user_id})")
+            else:
                 response_lines.append(f"{account['phone']}: not accessible or not found")
         except FloodWaitError as e:
             response_lines.append(f"{account['phone']}: flood wait {e.seconds}s")
         except Exception as e:
             response_lines.append(f"{account['phone']}: error - {e}")
-    await event.respond("\n".join(response_lines))
+    stats = username_cache.stats()
+    response_lines.append(f"(cache: {stats['hits']} hits, {stats['misses']} misses, {stats['coalesced']} coalesced, {stats['evictions']} evictions)")
+    reply(event, "\n".join(response_lines))
 
+@command("simulate_report", POLICY_STAFF)
 async def simulate_report_handler(event):
-    if event.sender_id not in ADMIN_IDS and event.sender_id not in SUDO_APPROVED_USERS:
-        await event.respond("You are not authorized to use this command.")
-        return
     args = event.message.message.split(maxsplit=1)
     if len(args) < 2:
-        await event.respond("Usage: /simulate_report target_description")
+        reply(event, "Usage: /simulate_report target_description")
         return
     target = args[1]
     performer = str(event.sender_id)
+    await sim_log_ready.wait()
     log_simulated_action("simulate_report", target, performer, details="User-triggered simulation")
-    await event.respond(f"Simulated report logged for: {target}")
+    reply(event, f"Simulated report logged for: {target}")
 
 bot = TelegramClient("bot_session", BOT_API_ID, BOT_API_HASH)
 
-async def main():
-    for acc in ACCOUNT_DETAILS:
-        phone = acc.get("phone")
-        api_id = acc.get("api_id")
-        api_hash = acc.get("api_hash")
-        session = acc.get("session", f"session_{phone}")
-        proxy = acc.get("proxy")
-        proxy_settings = None
-        if proxy:
-            proxy_settings = {
-                "proxy_type": "http",
-                "addr": proxy.get("ip"),
-                "port": proxy.get("port"),
-                "username": proxy.get("username"),
-                "password": proxy.get("password"),
-                "rdns": True
-            }
-        client = TelegramClient(session, api_id, api_hash, proxy=proxy_settings)
-        try:
-            await client.start(phone=phone)
-            me = await client.get_me()
-            reporting_clients.append((client, acc))
-            print(f"Started client for {acc.get('phone')} (me: {getattr(me, 'phone', 'unknown')})")
-        except Exception as e:
-            print(f"Failed to start client for {phone}: {e}")
+@command("start", POLICY_STAFF, denied="You are not authorized to use this bot.", inline=True)
+async def start_handler(event):
+    buttons = [
+        [Button.inline("Scan Users", data="scan")],
+        [Button.inline("Resolve Username", data="resolve")],
+        [Button.inline("List Accounts", data="list_accounts")],
+        [Button.inline("Add Account", data="add_account")],
+        [Button.inline("Delete Account", data="delete_account")],
+        [Button.inline("Simulate Report (safe)", data="simulate_report")],
+    ]
+    reply(event, "Admin helper bot - choose an action:", buttons=buttons)
 
-    if BOT_TOKEN is None:
-        print("BOT_TOKEN missing in config.py; bot commands disabled. Exiting.")
+@callback("scan")
+async def scan_button(event, data):
+    reply(event, "Please run /scan in the group you want to scan (this button just reminds you).")
+
+@callback("resolve")
+async def resolve_button(event, data):
+    reply(event, "Use /resolve @username to check accessibility across configured accounts.")
+
+@callback("list_accounts")
+async def list_accounts_button(event, data):
+    if not ACCOUNT_DETAILS:
+        reply(event, "No accounts configured.")
         return
+    reply(event, format_accounts("Configured accounts"))
 
-    await bot.start(bot_token=BOT_TOKEN)
-    print("Bot started")
+@callback("add_account")
+async def add_account_button(event, data):
+    await begin_flow(event.sender_id, "add_phone")
+    reply(event, "Starting add-account flow. Please send the phone number (e.g., +1234567890).")
 
-    asyncio.create_task(check_sudo_expirations())
+@callback("delete_account")
+async def delete_account_button(event, data):
+    await begin_flow(event.sender_id, "delete_phone")
+    reply(event, "Send the phone number to delete (e.g., +1234567890).")
 
-    @bot.on(events.NewMessage(pattern="/start"))
-    async def start_handler(event):
-        if event.sender_id not in ADMIN_IDS and event.sender_id not in SUDO_APPROVED_USERS:
-            await event.respond("You are not authorized to use this bot.")
-            return
-        buttons = [
-            [Button.inline("Scan Users", data="scan")],
-            [Button.inline("Resolve Username", data="resolve")],
-            [Button.inline("List Accounts", data="list_accounts")],
-            [Button.inline("Add Account", data="add_account")],
-            [Button.inline("Delete Account", data="delete_account")],
-            [Button.inline("Simulate Report (safe)", data="simulate_report")],
-        ]
-        await event.respond("Admin helper bot - choose an action:", buttons=buttons)
-
-    @bot.on(events.CallbackQuery)
-    async def callback_handler(event):
-        data = event.data.decode() if isinstance(event.data, (bytes, bytearray)) else str(event.data)
-        uid = event.sender_id
-        if uid not in ADMIN_IDS and uid not in SUDO_APPROVED_USERS:
-            await event.answer("Not authorized.")
-            return
+@callback("simulate_report")
+async def simulate_report_button(event, data):
+    reply(event, "Use /simulate_report <target_description> to create a harmless log entry.")
 
-        if data == "scan":
-            await event.respond("Please run /scan in the group you want to scan (this button just reminds you).")
-        elif data == "resolve":
-            await event.respond("Use /resolve @username to check accessibility across configured accounts.")
-        elif data == "list_accounts":
-            if not ACCOUNT_DETAILS:
-                await event.respond("No accounts configured.")
-            else:
-                resp = "Configured accounts:\n"
-                for a in ACCOUNT_DETAILS:
-                    proxy = a.get("proxy")
-                    ps = "no proxy" if not proxy else f"{proxy.get('ip')}:{proxy.get('port')}"
-                    resp += f"- {a.get('phone')} (session: {a.get('session')}) [{ps}]\n"
-                await event.respond(resp)
-        elif data == "add_account":
-            user_states[uid] = {"step": "add_phone"}
-            await event.respond("Starting add-account flow. Please send the phone number (e.g., +1234567890).")
-        elif data == "delete_account":
-            user_states[uid] = {"step": "delete_phone"}
-            await event.respond("Send the phone number to delete (e.g., +1234567890).")
-        elif data == "simulate_report":
-            await event.respond("Use /simulate_report <target_description> to create a harmless log entry.")
+@callback("ls", POLICY_ADMIN, gate="log")
+async def log_search_page_button(event, data):
+    _, token, page = data.split(":")
+    await show_log_search_page(event, token, int(page), edit=True)
 
-        await event.answer()
+@command("scan", gate="api")
+async def scan_handler(event):
+    if not reporting_clients:
+        reply(event, "No reporting clients are configured to perform scanning. Please add at least one account.")
+        return
+    try:
+        session = await first_ready_session()
+    except Exception as e:
+        reply(event, f"No reporting client could connect: {e}")
+        return
+    await scan_users(event, session.client, session.account)
 
-    @bot.on(events.NewMessage(pattern="/scan"))
-    async def scan_handler(event):
-        if event.sender_id not in ADMIN_IDS:
-            await event.respond("You are not authorized.")
-            return
-        if not reporting_clients:
-            await event.respond("No reporting clients are configured to perform scanning. Please add at least one account.")
+@command("report_count", gate="log")
+async def report_count_cmd(event):
+    await sim_log_ready.wait()
+    parts = event.message.message.split()
+    window = parts[1].lower() if len(parts) > 1 else None
+    if window is not None and window not in SimLogStats.WINDOWS:
+        reply(event, "Usage: /report_count [hour|day|week]")
+        return
+    if not sim_log_stats.total:
+        reply(event, "No simulated actions logged yet.")
+        return
+    performers, actions = sim_log_stats.counts(window)
+    title = "Simulated action counts" + (f" (last {window})" if window else "")
+    if not performers:
+        reply(event, f"{title}: none.")
+        return
+    lines = [f"{title}:"]
+    lines.extend(f"{who}: {c}" for who, c in performers.most_common())
+    lines.append("")
+    lines.append("By action:")
+    lines.extend(f"{action}: {c}" for action, c in actions.most_common())
+    reply(event, "\n".join(lines))
+
+@command("log_search", gate="log")
+async def log_search_cmd(event):
+    args = event.message.message.split(maxsplit=1)
+    try:
+        query = parse_log_search_args(args[1] if len(args) > 1 else "")
+        if query["target"] is not None and len(query["target"]) < 3:
+            raise ValueError("target= needs at least 3 characters")
+    except ValueError as e:
+        reply(event, f"Invalid search: {e}\nUsage: /log_search [by=<user_id>] [action=<name>] [target=<text>] [since=<1h|2d|...>] [from=<YYYY-MM-DD>] [to=<YYYY-MM-DD>]")
+        return
+    await sim_log_ready.wait()
+    await asyncio.to_thread(sim_log.flush)
+    token = secrets.token_hex(4)
+    log_searches[token] = {"query": query, "pages": [sim_log_store.rows_total - 1]}
+    while len(log_searches) > LOG_SEARCH_MAX_SESSIONS:
+        log_searches.popitem(last=False)
+    await show_log_search_page(event, token, 0)
+
+@command("report_export", gate="export")
+async def report_export_cmd(event):
+    args = event.message.message.split(maxsplit=1)
+    try:
+        query = parse_log_search_args(args[1] if len(args) > 1 else "")
+    except ValueError as e:
+        reply(event, f"Invalid export filter: {e}\nUsage: /report_export [by=<user_id>] [since=<1h|2d|...>] [from=<YYYY-MM-DD>] [to=<YYYY-MM-DD>]")
+        return
+    await sim_log_ready.wait()
+    await asyncio.to_thread(sim_log.flush)
+    tmp_dir = tempfile.mkdtemp(prefix="sim_export_")
+    path = os.path.join(tmp_dir, time.strftime("simulated_actions-%Y%m%dT%H%M%S.csv.gz", time.gmtime()))
+    try:
+        count = await asyncio.to_thread(export_log, query, path)
+        if not count:
+            reply(event, "No matching log entries to export.")
             return
-        await scan_users(event, reporting_clients[0][0])
+        await bot.send_file(event.chat_id, path, caption=f"Exported {count} simulated log rows.", force_document=True)
+    except Exception as e:
+        reply(event, f"Export failed: {e}")
+    finally:
+        await asyncio.to_thread(shutil.rmtree, tmp_dir, True)
 
-    @bot.on(events.NewMessage(pattern=r"^/resolve\b"))
-    async def resolve_handler(event):
-        await resolve_user(event)
+@command("sudo", gate="api")
+async def sudo_cmd(event):
+    parts = event.message.message.split()
+    if len(parts) < 3:
+        reply(event, "Usage: /sudo <user_id_or_@username> <duration> (e.g., /sudo 123456789 1 week)")
+        return
+    target = parts[1]
+    duration_str = " ".join(parts[2:4]) if len(parts) >= 4 else parts[2]
+    target_id = await resolve_target(event, target)
+    if target_id is None:
+        return
+    try:
+        seconds = parse_duration(duration_str)
+    except Exception as e:
+        reply(event, f"Invalid duration: {e}")
+        return
+    expiry = sudo_scheduler.grant(target_id, seconds)
+    reply(event, f"Approved {target_id} until {expiry.isoformat()} UTC.")
 
-    @bot.on(events.NewMessage(pattern=r"^/simulate_report\b"))
-    async def simulate_report_cmd(event):
-        await simulate_report_handler(event)
+@command("unsudo", gate="api")
+async def unsudo_cmd(event):
+    parts = event.message.message.split()
+    if len(parts) < 2:
+        reply(event, "Usage: /unsudo <user_id_or_@username>")
+        return
+    target = parts[1]
+    target_id = await resolve_target(event, target)
+    if target_id is None:
+        return
+    if sudo_scheduler.revoke(target_id):
+        reply(event, f"Removed sudo approval for {target_id}.")
+    else:
+        reply(event, "That user is not approved.")
 
-    @bot.on(events.NewMessage(pattern=r"^/report_count\b"))
-    async def report_count_cmd(event):
-        if event.sender_id not in ADMIN_IDS:
-            await event.respond("Not authorized.")
-            return
-        counts = {}
-        if not os.path.isfile(SIM_LOG_FILE):
-            await event.respond("No simulated actions logged yet.")
-            return
-        try:
-            with open(SIM_LOG_FILE, "r", encoding="utf-8") as f:
-                rdr = csv.reader(f)
-                headers = next(rdr, None)
-                for row in rdr:
-                    if len(row) >= 4:
-                        performed_by = row[3]
-                        counts[performed_by] = counts.get(performed_by, 0) + 1
-            resp = "Simulated action counts:\n"
-            for who, c in counts.items():
-                resp += f"{who}: {c}\n"
-            await event.respond(resp)
-        except Exception as e:
-            await event.respond(f"Error reading log: {e}")
+@command("add")
+async def add_begin(event):
+    await begin_flow(event.sender_id, "add_phone")
+    reply(event, "Enter phone (e.g., +1234567890):")
 
-    @bot.on(events.NewMessage(pattern=r"^/sudo\b"))
-    async def sudo_cmd(event):
-        if event.sender_id not in ADMIN_IDS:
-            await event.respond("Not authorized.")
-            return
-        parts = event.message.message.split()
-        if len(parts) < 3:
-            await event.respond("Usage: /sudo <user_id_or_@username> <duration> (e.g., /sudo 123456789 1 week)")
+@command("delete")
+async def delete_begin(event):
+    await begin_flow(event.sender_id, "delete_phone")
+    reply(event, "Send the phone number to delete (e.g., +1234567890).")
+
+@metrics.timed
+async def generic_flow(event):
+    uid = event.sender_id
+    if uid not in user_states:
+        return
+    state = user_states[uid]
+    step = state.get("step")
+    if step == "add_phone":
+        phone = event.message.message.strip()
+        if not phone.startswith("+"):
+            reply(event, "Phone must start with '+'. Try again or /cancel")
             return
-        target = parts[1]
-        duration_str = " ".join(parts[2:4]) if len(parts) >= 4 else parts[2]
-        target_id = None
-        if target.startswith("@"):
-            uname = target.lstrip("@")
-            if reporting_clients:
-                try:
-                    res = await reporting_clients[0][0](ResolveUsernameRequest(uname))
-                    for u in res.users:
-                        if getattr(u, "username", None) and u.username.lower() == uname.lower():
-                            target_id = u.id
-                            break
-                except Exception as e:
-                    await event.respond(f"Error resolving username: {e}")
-                    return
-            else:
-                await event.respond("No accounts available to resolve username; please provide a user ID.")
-                return
-        else:
-            try:
-                target_id = int(target)
-            except ValueError:
-                await event.respond("Invalid target. Provide a user ID or @username.")
+        state["new_account"] = {"phone": phone}
+        state["step"] = "add_api_id"
+        user_states[uid] = state
+        reply(event, "Enter API ID (number):")
+    elif step == "add_api_id":
+        try:
+            api_id = int(event.message.message.strip())
+            state["new_account"]["api_id"] = api_id
+            state["step"] = "add_api_hash"
+            user_states[uid] = state
+            reply(event, "Enter API hash:")
+        except ValueError:
+            reply(event, "API ID must be a number. Try again.")
+    elif step == "add_api_hash":
+        api_hash = event.message.message.strip()
+        state["new_account"]["api_hash"] = api_hash
+        state["step"] = "add_session"
+        user_states[uid] = state
+        reply(event, "Enter session name (e.g., session_2):")
+    elif step == "add_session":
+        session = event.message.message.strip()
+        state["new_account"]["session"] = session
+        new_acc = state["new_account"]
+        new_acc.setdefault("proxy", None)
+        ACCOUNT_DETAILS.append(new_acc)
+        client = None
+        try:
+            client = await session_manager.open(new_acc["session"], new_acc["api_id"], new_acc["api_hash"])
+            sent_code = await client.send_code_request(new_acc["phone"])
+            if not user_states.holds(uid, state):
+                # /cancel (or a new flow) arrived while the code was being sent.
+                await session_manager.close(client)
+                ACCOUNT_DETAILS.remove(new_acc)
                 return
+            # Kept for sign_in in the next step; release_flow() closes it if the flow is abandoned.
+            state["_client"] = client
+            state["phone_code_hash"] = sent_code.phone_code_hash
+            state["step"] = "add_verification_code"
+            user_states[uid] = state
+            reply(event, f"Code sent to {new_acc['phone']}. Enter the code:")
+        except Exception as e:
+            if client is not None:
+                await session_manager.close(client)
+            ACCOUNT_DETAILS.remove(new_acc)
+            if user_states.holds(uid, state):
+                user_states.pop(uid, None)
+                reply(event, f"Failed to send code: {e}")
+    elif step == "add_verification_code":
+        code = event.message.message.strip()
+        new_acc = state["new_account"]
+        phone_code_hash = state.get("phone_code_hash")
+        client = state.pop("_client", None)
         try:
-            seconds = parse_duration(duration_str)
+            if client is None:
+                # Flow restored after a restart: the session file still holds the auth key.
+                client = await session_manager.open(new_acc["session"], new_acc["api_id"], new_acc["api_hash"])
+            await client.sign_in(phone=new_acc["phone"], code=code, phone_code_hash=phone_code_hash)
+            me = await client.get_me()
+            if not user_states.holds(uid, state):
+                # Cancelled during sign-in; release_flow() already unlisted the account.
+                await session_manager.close(client)
+                if new_acc in ACCOUNT_DETAILS:
+                    ACCOUNT_DETAILS.remove(new_acc)
+                return
+            reporting_clients.append(ReportingSession(new_acc, client))
+            state_store.put("accounts", new_acc["phone"], new_acc)
+            user_states.pop(uid, None)
+            reply(event, f"Successfully added account {new_acc['phone']}.")
         except Exception as e:
-            await event.respond(f"Invalid duration: {e}")
+            if client is not None:
+                await session_manager.close(client)
+            if new_acc in ACCOUNT_DETAILS:
+                ACCOUNT_DETAILS.remove(new_acc)
+            if user_states.holds(uid, state):
+                user_states.pop(uid, None)
+                if isinstance(e, SessionPasswordNeededError):
+                    reply(event, "Two-step verification enabled for account; cannot complete add via bot.")
+                else:
+                    reply(event, f"Failed to sign in: {e}")
+    elif step == "delete_phone":
+        phone = event.message.message.strip()
+        acc_to_remove = None
+        for a in ACCOUNT_DETAILS:
+            if a.get("phone") == phone:
+                acc_to_remove = a
+                break
+        if not acc_to_remove:
+            reply(event, "Account not found.")
+            user_states.pop(uid, None)
             return
-        expiry = datetime.utcnow() + timedelta(seconds=seconds)
-        SUDO_APPROVED_USERS[target_id] = expiry
-        await event.respond(f"Approved {target_id} until {expiry.isoformat()} UTC.")
+        ACCOUNT_DETAILS.remove(acc_to_remove)
+        state_store.put("accounts", phone, None)
+        for session in list(reporting_clients):
+            if session.phone == phone:
+                await session.disconnect()
+                reporting_clients.remove(session)
+        session_name = acc_to_remove.get("session")
+        session_file = f"{session_name}.session"
+        try:
+            await asyncio.to_thread(remove_file, session_file)
+            reply(event, f"Removed account {phone}.")
+        except Exception:
+            reply(event, f"Removed account {phone}, but failed to remove session file.")
+        # The removal is finished even if /cancel arrived meanwhile; only clear our own flow.
+        if user_states.holds(uid, state):
+            user_states.pop(uid, None)
 
-    @bot.on(events.NewMessage(pattern=r"^/unsudo\b"))
-    async def unsudo_cmd(event):
-        if event.sender_id not in ADMIN_IDS:
-            await event.respond("Not authorized.")
-            return
-        parts = event.message.message.split()
-        if len(parts) < 2:
-            await event.respond("Usage: /unsudo <user_id_or_@username>")
+def remove_file(path: str):
+    if os.path.exists(path):
+        os.remove(path)
+
+@command("list")
+async def list_cmd(event):
+    if not ACCOUNT_DETAILS:
+        reply(event, "No accounts registered.")
+        return
+    reply(event, format_accounts("Registered accounts"))
+
+@command("function", POLICY_STAFF, inline=True)
+async def function_cmd(event):
+    cmds = [
+        "/start - show main menu",
+        "/scan - scan users in the group where you run this (admin)",
+        "/resolve @username - check accessibility of username across accounts (admin)",
+        "/list - list configured accounts (admin)",
+        "/add - add an account interactively (admin)",
+        "/delete - delete an account interactively (admin)",
+        "/simulate_report - harmless log-only simulation of a report",
+        "/report_count [hour|day|week] - show counts from simulated log (admin)",
+        "/log_search [by=] [action=] [target=] [since=|from=] [to=] - search the simulated log (admin)",
+        "/report_export [by=] [since=|from=] [to=] - download the simulated log as .csv.gz (admin)",
+        "/stats - handler latencies, API calls, queue depths and memory (admin)",
+        "/sudo - grant sudo approval (admin)",
+        "/unsudo - remove sudo approval (admin)",
+    ]
+    reply(event, "Available commands:\n" + "\n".join(cmds))
+
+@command("stats")
+async def stats_cmd(event):
+    text = metrics.summary()
+    top = await asyncio.to_thread(metrics.top_allocations)
+    if top:
+        text += "\nTop allocations:\n" + "\n".join(f"- {where}: {size / 1024:.0f} KiB in {count} blocks"
+                                                   for where, size, count in top)
+    reply(event, text)
+
+def register_gauges():
+    metrics.gauge("sim_log_queue", sim_log.pending)
+    metrics.gauge("state_store_queue", state_store.pending)
+    metrics.gauge("outbox_queue", outbox.pending)
+    metrics.gauge("user_queues", lambda: len(user_serializer))
+    metrics.gauge("user_queue_updates", user_serializer.pending)
+    metrics.gauge("active_flows", lambda: len(user_states))
+    metrics.gauge("sudo_users", lambda: len(SUDO_APPROVED_USERS))
+    metrics.gauge("open_account_clients", lambda: len(session_manager))
+    metrics.gauge("loop_lag_seconds", lambda: loop_watchdog.last_lag)
+    metrics.gauge("loop_lag_p99_seconds", lambda: loop_watchdog.lag.quantile(0.99))
+    metrics.gauge("loop_lag_max_seconds", lambda: loop_watchdog.max_lag)
+    metrics.gauge("loop_stalls", lambda: loop_watchdog.stalls)
+    metrics.gauge("username_cache_size", lambda: username_cache.stats()["size"])
+    metrics.gauge("username_cache_hits", lambda: username_cache.hits)
+    metrics.gauge("username_cache_misses", lambda: username_cache.misses)
+    metrics.gauge("username_cache_evictions", lambda: username_cache.evictions)
+    for name, gate in ADMISSION_GATES.items():
+        metrics.gauge(f"admission_{name}_running", lambda g=gate: g.running)
+        metrics.gauge(f"admission_{name}_waiting", lambda g=gate: g.waiting)
+        metrics.gauge(f"admission_{name}_rejected", lambda g=gate: g.rejected)
+
+@command("cancel", POLICY_OPEN, inline=True)
+async def cancel_cmd(event):
+    if event.sender_id in user_states:
+        await release_flow(user_states.pop(event.sender_id))
+        reply(event, "Operation cancelled.")
+    else:
+        reply(event, "No active operation.")
+
+class UserSerializer:
+    # Runs each sender's updates one at a time in arrival order, so the
+    # multi-step flows never interleave, while different senders run
+    # concurrently. A sender's queue only exists while it has pending updates.
+    def __init__(self):
+        self._queues: Dict[int, deque] = {}
+
+    def __len__(self) -> int:
+        return len(self._queues)
+
+    def __contains__(self, uid: int) -> bool:
+        return uid in self._queues
+
+    def pending(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+
+    def submit(self, uid: int, handler, *args):
+        q = self._queues.get(uid)
+        if q is not None:
+            q.append((handler, args))
             return
-        target = parts[1]
-        target_id = None
-        if target.startswith("@"):
-            uname = target.lstrip("@")
-            if reporting_clients:
+        q = self._queues[uid] = deque([(handler, args)])
+        asyncio.create_task(self._run(uid, q))
+
+    async def _run(self, uid: int, q: deque):
+        try:
+            while q:
+                handler, args = q[0]
                 try:
-                    res = await reporting_clients[0][0](ResolveUsernameRequest(uname))
-                    for u in res.users:
-                        if getattr(u, "username", None) and u.username.lower() == uname.lower():
-                            target_id = u.id
-                            break
+                    await handler(*args)
                 except Exception as e:
-                    await event.respond(f"Error resolving username: {e}")
-                    return
-            else:
-                await event.respond("No accounts available to resolve username; please provide a user ID.")
-                return
-        else:
-            try:
-                target_id = int(target)
-            except ValueError:
-                await event.respond("Invalid target. Provide a user ID or @username.")
-                return
-        if target_id in SUDO_APPROVED_USERS:
-            SUDO_APPROVED_USERS.pop(target_id, None)
-            await event.respond(f"Removed sudo approval for {target_id}.")
-        else:
-            await event.respond("That user is not approved.")
+                    print(f"Error handling update from {uid}: {e!r}")
+                q.popleft()
+        finally:
+            self._queues.pop(uid, None)
 
-    @bot.on(events.NewMessage(pattern=r"^/add\b"))
-    async def add_begin(event):
-        if event.sender_id not in ADMIN_IDS:
-            await event.respond("Not authorized.")
-            return
-        user_states[event.sender_id] = {"step": "add_phone"}
-        await event.respond("Enter phone (e.g., +1234567890):")
+user_serializer = UserSerializer()
 
-    @bot.on(events.NewMessage)
-    async def generic_flow(event):
-        uid = event.sender_id
-        if uid not in user_states:
-            return
-        state = user_states[uid]
-        step = state.get("step")
-        if step == "add_phone":
-            phone = event.message.message.strip()
-            if not phone.startswith("+"):
-                await event.respond("Phone must start with '+'. Try again or /cancel")
-                return
-            state["new_account"] = {"phone": phone}
-            state["step"] = "add_api_id"
-            user_states[uid] = state
-            await event.respond("Enter API ID (number):")
-        elif step == "add_api_id":
-            try:
-                api_id = int(event.message.message.strip())
-                state["new_account"]["api_id"] = api_id
-                state["step"] = "add_api_hash"
-                user_states[uid] = state
-                await event.respond("Enter API hash:")
-            except ValueError:
-                await event.respond("API ID must be a number. Try again.")
-        elif step == "add_api_hash":
-            api_hash = event.message.message.strip()
-            state["new_account"]["api_hash"] = api_hash
-            state["step"] = "add_session"
-            user_states[uid] = state
-            await event.respond("Enter session name (e.g., session_2):")
-        elif step == "add_session":
-            session = event.message.message.strip()
-            state["new_account"]["session"] = session
-            new_acc = state["new_account"]
-            new_acc.setdefault("proxy", None)
-            ACCOUNT_DETAILS.append(new_acc)
-            client = TelegramClient(new_acc["session"], new_acc["api_id"], new_acc["api_hash"])
-            try:
-                await client.connect()
-                sent_code = await client.send_code_request(new_acc["phone"])
-                state["phone_code_hash"] = sent_code.phone_code_hash
-                state["step"] = "add_verification_code"
-                user_states[uid] = state
-                await event.respond(f"Code sent to {new_acc['phone']}. Enter the code:")
-            except Exception as e:
-                ACCOUNT_DETAILS.remove(new_acc)
-                user_states.pop(uid, None)
-                await event.respond(f"Failed to send code: {e}")
-        elif step == "add_verification_code":
-            code = event.message.message.strip()
-            new_acc = state["new_account"]
-            phone_code_hash = state.get("phone_code_hash")
-            client = TelegramClient(new_acc["session"], new_acc["api_id"], new_acc["api_hash"])
-            try:
-                await client.connect()
-                await client.sign_in(phone=new_acc["phone"], code=code, phone_code_hash=phone_code_hash)
-                me = await client.get_me()
-                reporting_clients.append((client, new_acc))
-                user_states.pop(uid, None)
-                await event.respond(f"Successfully added account {new_acc['phone']}.")
-            except SessionPasswordNeededError:
-                await event.respond("Two-step verification enabled for account; cannot complete add via bot.")
-                await client.disconnect()
-                ACCOUNT_DETAILS.remove(new_acc)
-                user_states.pop(uid, None)
-            except Exception as e:
-                await event.respond(f"Failed to sign in: {e}")
-                await client.disconnect()
-                ACCOUNT_DETAILS.remove(new_acc)
-                user_states.pop(uid, None)
-        elif step == "delete_phone":
-            phone = event.message.message.strip()
-            acc_to_remove = None
-            for a in ACCOUNT_DETAILS:
-                if a.get("phone") == phone:
-                    acc_to_remove = a
-                    break
-            if not acc_to_remove:
-                await event.respond("Account not found.")
-                user_states.pop(uid, None)
-                return
-            ACCOUNT_DETAILS.remove(acc_to_remove)
-            for client, acc in list(reporting_clients):
-                if acc.get("phone") == phone:
-                    await client.disconnect()
-                    reporting_clients.remove((client, acc))
-            session_name = acc_to_remove.get("session")
-            session_file = f"{session_name}.session"
-            try:
-                if os.path.exists(session_file):
-                    os.remove(session_file)
-                await event.respond(f"Removed account {phone}.")
-            except Exception:
-                await event.respond(f"Removed account {phone}, but failed to remove session file.")
-            user_states.pop(uid, None)
+class UpdateRecorder:
+    # Appends every incoming update as a JSON line that `bench.py replay` can
+    # play back: {"t": seconds since recording started, "type": "message" or
+    # "callback", "sender_id", "chat_id", "text" or "data"}. Lines go through the
+    # file's write buffer, so the loop rarely waits on disk; close() flushes it.
+    def __init__(self, path: str):
+        self.path = path
+        self.started = time.monotonic()
+        self._file = open(path, "a", encoding="utf-8")
 
-    @bot.on(events.NewMessage(pattern=r"^/list\b"))
-    async def list_cmd(event):
-        if event.sender_id not in ADMIN_IDS:
-            await event.respond("Not authorized.")
-            return
-        if not ACCOUNT_DETAILS:
-            await event.respond("No accounts registered.")
-            return
-        resp = "Registered accounts:\n"
-        for a in ACCOUNT_DETAILS:
-            proxy = a.get("proxy")
-            ps = "no proxy" if not proxy else f"{proxy.get('ip')}:{proxy.get('port')}"
-            resp += f"- {a.get('phone')} (session: {a.get('session')}) [{ps}]\n"
-        await event.respond(resp)
-
-    @bot.on(events.NewMessage(pattern=r"^/function\b"))
-    async def function_cmd(event):
-        uid = event.sender_id
-        if uid not in ADMIN_IDS and uid not in SUDO_APPROVED_USERS:
-            await event.respond("Not authorized.")
-            return
-        cmds = [
-            "/start - show main menu",
-            "/scan - scan users in the group where you run this (admin)",
-            "/resolve @username - check accessibility of username across accounts (admin)",
-            "/list - list configured accounts (admin)",
-            "/add - add an account interactively (admin)",
-            "/delete - delete an account interactively (admin)",
-            "/simulate_report - harmless log-only simulation of a report",
-            "/report_count - show counts from simulated log (admin)",
-            "/sudo - grant sudo approval (admin)",
-            "/unsudo - remove sudo approval (admin)",
-        ]
-        await event.respond("Available commands:\n" + "\n".join(cmds))
-
-    @bot.on(events.NewMessage(pattern=r"^/cancel\b"))
-    async def cancel_cmd(event):
-        if event.sender_id in user_states:
-            user_states.pop(event.sender_id, None)
-            await event.respond("Operation cancelled.")
-        else:
-            await event.respond("No active operation.")
+    def record(self, kind: str, event, **fields):
+        entry = {"t": round(time.monotonic() - self.started, 6), "type": kind,
+                 "sender_id": event.sender_id, "chat_id": event.chat_id}
+        entry.update(fields)
+        self._file.write(json.dumps(entry) + "\n")
+
+    def close(self):
+        self._file.close()
+
+update_recorder: Optional[UpdateRecorder] = None
+
+def lookup_command(text: str) -> Optional[CommandSpec]:
+    if not text or not text.startswith("/"):
+        return None
+    return COMMANDS.get(text.split(maxsplit=1)[0][1:].partition("@")[0])
 
+async def on_new_message(event):
+    if update_recorder is not None:
+        update_recorder.record("message", event, text=event.message.message)
+    spec = lookup_command(event.message.message)
+    if spec is not None and spec.inline:
+        await run_command(spec, event)
+        return
+    uid = event.sender_id or event.chat_id
+    if spec is None and event.sender_id not in user_states and uid not in user_serializer:
+        # Plain chatter from someone with no flow (and no queued /add or
+        # /delete that could start one) never reaches generic_flow.
+        return
+    user_serializer.submit(uid, dispatch_message, event, spec)
+
+async def on_callback_query(event):
+    # Routing and the answer happen right away so the client's spinner clears
+    # even when the sender's earlier updates (or an admission slot) are slow;
+    # only the routed handler waits in the sender's queue.
+    data = event.data.decode() if isinstance(event.data, (bytes, bytearray)) else str(event.data)
+    if update_recorder is not None:
+        update_recorder.record("callback", event, data=data)
+    entry = CALLBACKS.get(data.split(":", 1)[0])
+    if entry is None:
+        await event.answer()
+        return
+    if not is_authorized(event.sender_id, entry.policy):
+        await event.answer("Not authorized.")
+        return
+    try:
+        await event.answer()
+    except Exception as e:
+        print(f"Failed to answer callback query from {event.sender_id}: {e!r}")
+    user_serializer.submit(event.sender_id or event.chat_id, callback_handler, event, entry, data)
+
+@metrics.timed
+async def dispatch_message(event, spec: CommandSpec = None):
+    # Single NewMessage entry point: the command token is parsed once and looked
+    # up in COMMANDS; everything else goes to the add/delete conversation flow.
+    if spec is None:
+        spec = lookup_command(event.message.message)
+    if spec is None:
+        await generic_flow(event)
+        return
+    await run_command(spec, event)
+
+async def run_command(spec: CommandSpec, event):
+    if not is_authorized(event.sender_id, spec.policy):
+        reply(event, spec.denied)
+        return
+    await run_admitted(spec.gate, event, spec.handler)
+
+@metrics.timed
+async def callback_handler(event, entry: CallbackSpec, data: str):
+    await run_admitted(entry.gate, event, entry.handler, data)
+
+
+def restore_state(saved: Dict[str, Dict[str, Any]]):
+    # Accounts map phone -> account dict, or None for accounts deleted at runtime.
+    for phone, acc in saved["accounts"].items():
+        for existing in [a for a in ACCOUNT_DETAILS if a.get("phone") == phone]:
+            ACCOUNT_DETAILS.remove(existing)
+        if acc is not None:
+            ACCOUNT_DETAILS.append(acc)
+    now = time.time()
+    for uid, expires in saved["sudo"].items():
+        if expires > now:
+            sudo_scheduler.grant(int(uid), expires - now)
+    for uid, state in saved["flows"].items():
+        if state.get("step") == "add_verification_code":
+            # The pending account is listed while its code is being verified.
+            ACCOUNT_DETAILS.append(state["new_account"])
+        user_states[int(uid)] = state
+    username_cache.load(saved["usernames"].values())
+    return {table: len(rows) for table, rows in saved.items()}
+
+def snapshot_state():
+    # Keys starting with "_" hold live objects (e.g. clients) and are not persisted.
+    state_store.snapshot("sudo", sudo_scheduler.dump())
+    state_store.snapshot("flows", {uid: {k: v for k, v in state.items() if not k.startswith("_")}
+                                   for uid, state in user_states.items()})
+    state_store.snapshot("usernames", {json.dumps([e[0], e[1]]): list(e) for e in username_cache.dump()})
+
+async def restore_sim_log():
+    try:
+        replayed = await asyncio.to_thread(sim_log.restore)
+        print(f"Simulated log restored ({sim_log_stats.total} rows, {replayed} replayed from log tail)")
+    finally:
+        sim_log_ready.set()
+
+async def main():
+    global update_recorder
+    timer = StartupTimer()
+    if METRICS_TRACEMALLOC:
+        tracemalloc.start()
+    if LOOP_LAG_THRESHOLD:
+        loop_watchdog.start()
+    if BOT_TOKEN is None:
+        print("BOT_TOKEN missing in config.py; bot commands disabled. Exiting.")
+        return
+
+    with timer.phase("state restore"):
+        restored = restore_state(await asyncio.to_thread(state_store.load))
+    print(f"State restored from {STATE_DB}: " + ", ".join(f"{n} {table}" for table, n in restored.items()))
+
+    with timer.phase("bot login"):
+        await bot.start(bot_token=BOT_TOKEN)
+    print("Bot started")
+
+    with timer.phase("handler registration"):
+        # Reporting accounts connect lazily on first use (see ReportingSession).
+        # Accounts of restored add flows get their session once the code is verified.
+        pending = pending_accounts()
+        for acc in ACCOUNT_DETAILS:
+            if not any(acc is p for p in pending):
+                reporting_clients.append(ReportingSession(acc))
+        asyncio.create_task(sudo_scheduler.run())
+        asyncio.create_task(user_states.run())
+        register_gauges()
+        if UPDATE_RECORD_FILE:
+            update_recorder = UpdateRecorder(UPDATE_RECORD_FILE)
+            print(f"Recording incoming updates to {UPDATE_RECORD_FILE}")
+        if METRICS_ENABLED and METRICS_FILE:
+            asyncio.create_task(metrics.run_exporter(METRICS_FILE, METRICS_INTERVAL))
+        bot.add_event_handler(on_new_message, events.NewMessage())
+        bot.add_event_handler(on_callback_query, events.CallbackQuery())
+    print(timer.report())
+
+    with timer.phase("simulated log restore"):
+        await restore_sim_log()
+    print(timer.report())
+
+    # Docker and Heroku stop the bot with SIGTERM, whose default action skips
+    # the cleanup below; cancel this task instead so queued log rows, flows and
+    # the username cache are saved.
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        with contextlib.suppress(NotImplementedError, RuntimeError):
+            loop.add_signal_handler(sig, asyncio.current_task().cancel)
     print("Bot event handlers registered. Running...")
     try:
         await asyncio.Event().wait()
-    except (KeyboardInterrupt, SystemExit):
+    except (KeyboardInterrupt, SystemExit, asyncio.CancelledError):
         print("Shutting down...")
     finally:
-        for client, _ in reporting_clients:
-            try:
-                await client.disconnect()
-            except Exception:
-                pass
+        loop_watchdog.stop()
+        if update_recorder is not None:
+            update_recorder.close()
+        await asyncio.to_thread(sim_log.close)
+        snapshot_state()
+        await asyncio.to_thread(state_store.close)
+        await session_manager.close_all()
         await bot.disconnect()
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    run_event_loop(main())
\ No newline at end of file